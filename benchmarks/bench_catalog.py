@@ -0,0 +1,85 @@
+"""
+
+    benchmarks.bench_catalog
+    ========================
+
+    Planning time on a synthetic 500-table schema.
+
+    Run with::
+
+        python -m benchmarks.bench_catalog
+
+"""
+
+import timeit
+
+from qc0 import Q
+from qc0.plan import plan
+from qc0.catalog import Catalog
+
+from .schema import make_meta
+
+
+def scan_rev_foreign_keys(table):
+    """ How reverse foreign keys were found before the catalog existed."""
+    return {
+        fk.parent.table.name: fk
+        for t in table.metadata.tables.values()
+        for fk in t.foreign_keys
+        if fk.column.table == table
+    }
+
+
+def main(size=500, number=200):
+    meta = make_meta(size)
+    q = Q(meta=meta, engine=None)
+    mid = size // 2
+    queries = {
+        "forward navigation": q.nav(f"t_{mid}")
+        .nav(f"t_{mid - 1}")
+        .nav(f"t_{mid - 2}")
+        .name,
+        "reverse navigation": q.nav(f"t_{mid}")
+        .nav(f"t_{mid + 1}")
+        .nav(f"t_{mid + 2}")
+        .name,
+        "select with aggregates": q.nav(f"t_{mid}").select(
+            name=q.name,
+            parent=q.nav(f"t_{mid - 1}").name,
+            children=q.nav(f"t_{mid + 1}").count(),
+        ),
+    }
+
+    def report(name, seconds):
+        print(f"  {name:<40} {seconds * 1e6:10.1f}us")
+
+    print(f"schema of {size} tables")
+    report(
+        "catalog build",
+        timeit.timeit(lambda: Catalog.make(meta), number=10) / 10,
+    )
+    table = meta.tables[f"t_{mid}"]
+    catalog = Catalog.of(meta)
+    report(
+        "cached catalog lookup",
+        timeit.timeit(lambda: Catalog.of(meta), number=number) / number,
+    )
+    report(
+        "reverse fk lookup (metadata scan)",
+        timeit.timeit(lambda: scan_rev_foreign_keys(table), number=number)
+        / number,
+    )
+    report(
+        "reverse fk lookup (catalog)",
+        timeit.timeit(
+            lambda: catalog.info(table).rev_foreign_keys, number=number
+        )
+        / number,
+    )
+    for name, query in queries.items():
+        seconds = timeit.timeit(lambda: plan(query.syn, meta), number=number)
+        report(f"plan: {name}", seconds / number)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""
+
+    benchmarks.bench_chain
+    ======================
+
+    Planning time for chained selects where each field references the field
+    defined by the previous select.
+
+    Run with::
+
+        python -m benchmarks.bench_chain
+
+"""
+
+import timeit
+
+from qc0 import Q
+from qc0.plan import plan
+
+from .schema import tpch_meta
+
+
+def chain(q, depth, fanout):
+    query = q.region.select(f0=q.name.length())
+    for i in range(1, depth + 1):
+        prev = q.nav(f"f{i - 1}")
+        expr = prev
+        for _ in range(fanout - 1):
+            expr = expr + prev
+        query = query.select(**{f"f{i}": expr})
+    return query
+
+
+def main(number=20):
+    meta = tpch_meta()
+    q = Q(meta=meta, engine=None)
+    for fanout in (1, 2):
+        print(f"fan-out {fanout}")
+        for depth in (2, 4, 8, 16):
+            syn = chain(q, depth, fanout).syn
+            seconds = (
+                timeit.timeit(lambda: plan(syn, meta), number=number) / number
+            )
+            print(f"  depth {depth:<4} {seconds * 1000:10.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
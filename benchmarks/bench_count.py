@@ -0,0 +1,52 @@
+"""
+
+    benchmarks.bench_count
+    ======================
+
+    Server side execution time of counts and existence tests over ``lineitem``
+    compiled with and without optimizations (which drop joins not affecting
+    the number of rows).
+
+    Requires a TPC-H database, connection is configured with the usual
+    ``PG*`` environment variables. Run with::
+
+        python -m benchmarks.bench_count
+
+"""
+
+import sqlalchemy as sa
+
+from qc0 import Q
+from qc0.plan import plan
+from qc0.compile import compile
+
+from .bench_json import execution_time
+
+
+def queries(q):
+    yield "lineitem.order.count()", q.lineitem.order.count()
+    yield "lineitem.partsupp.part.count()", q.lineitem.partsupp.part.count()
+    yield "order{n: lineitem.count()}", q.order.filter(
+        q.orderdate.year == 1995
+    ).select(n=q.lineitem.count())
+    yield "order.filter(lineitem.order.exists())", q.order.filter(
+        q.lineitem.order.exists()
+    ).count()
+
+
+def main(number=5):
+    engine = sa.create_engine("postgresql://")
+    meta = sa.MetaData()
+    meta.reflect(bind=engine)
+    q = Q(meta=meta, engine=engine)
+    with engine.connect() as conn:
+        for name, query in queries(q):
+            print(name)
+            for label, optimize in [("plain", False), ("optimized", True)]:
+                sql = compile(plan(query.syn, meta, optimize=optimize))
+                ms = min(execution_time(conn, sql) for _ in range(number))
+                print(f"  {label:<10} {ms:10.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+
+    benchmarks.bench_deep
+    =====================
+
+    Planning and compilation time for deeply chained queries.
+
+    Run with::
+
+        python -m benchmarks.bench_deep
+
+"""
+
+import time
+
+from qc0 import Q
+from qc0.plan import plan
+from qc0.compile import compile
+
+from .schema import tpch_meta
+
+
+def filters(q, depth):
+    query = q.region
+    for _ in range(depth):
+        query = query.filter(q.name != "x")
+    return query
+
+
+def selects(q, depth):
+    query = q.region.select(f0=q.name)
+    for i in range(1, depth + 1):
+        query = query.select(**{f"f{i}": q.nav(f"f{i - 1}")})
+    return query.nav(f"f{depth}")
+
+
+def navigations(q, depth):
+    query = q.nation
+    for _ in range(depth // 2):
+        query = query.region.nation
+    return query
+
+
+def main():
+    meta = tpch_meta()
+    q = Q(meta=meta, engine=None)
+    for name, make in [
+        ("filter", filters),
+        ("select", selects),
+        ("navigate", navigations),
+    ]:
+        print(name)
+        for depth in (100, 1000, 10000):
+            syn = make(q, depth).syn
+            started = time.perf_counter()
+            op = plan(syn, meta)
+            planned = time.perf_counter()
+            compile(op)
+            compiled = time.perf_counter()
+            print(
+                f"  depth {depth:<6}"
+                f" plan {(planned - started) * 1000:10.2f}ms"
+                f" compile {(compiled - planned) * 1000:10.2f}ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
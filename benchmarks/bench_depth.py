@@ -0,0 +1,40 @@
+"""
+
+    benchmarks.bench_depth
+    ======================
+
+    Nesting depth of ``SELECT`` statements compiled for the test corpus with
+    and without simplification.
+
+    Run with::
+
+        python -m benchmarks.bench_depth
+
+"""
+
+from qc0 import Q
+from qc0.plan import plan
+from qc0.compile import compile
+from qc0.simplify import nesting_depth
+
+from .schema import tpch_meta
+from .corpus import QUERIES
+
+
+def main():
+    meta = tpch_meta()
+    q = Q(meta=meta, engine=None)
+    ops = [plan(make(q).syn, meta) for make in QUERIES.values()]
+    print(f"nesting depth of {len(ops)} queries")
+    for label, simplify in [("plain", False), ("simplified", True)]:
+        depths = [nesting_depth(compile(op, simplify=simplify)) for op in ops]
+        print(
+            f"  {label:<10}"
+            f" total {sum(depths):5d}"
+            f" max {max(depths):3d}"
+            f" avg {sum(depths) / len(depths):6.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+
+    benchmarks.bench_json
+    =====================
+
+    Server side execution time of nested selects built as jsonb (as they are
+    compiled without optimizations) and as json.
+
+    Requires a TPC-H database, connection is configured with the usual
+    ``PG*`` environment variables. Run with::
+
+        python -m benchmarks.bench_json
+
+"""
+
+import json
+
+import sqlalchemy as sa
+
+from qc0 import Q
+from qc0.base import trampoline
+from qc0.plan import plan
+from qc0.compile import compile
+from qc0 import optimize as optimizer
+
+
+def queries(q):
+    yield "customer", q.customer.select(
+        name=q.name, nation=q.nation.name, phone=q.phone, acctbal=q.acctbal
+    )
+    yield "customer orders", q.customer.select(
+        name=q.name,
+        orders=q.order.select(key=q.id, date=q.orderdate, price=q.totalprice),
+    )
+    yield "region nations customers", q.region.select(
+        name=q.name,
+        nations=q.nation.select(
+            name=q.name,
+            customers=q.customer.select(name=q.name, phone=q.phone),
+        ),
+    )
+
+
+def execution_time(conn, sql):
+    """ Execution time (in ms) reported by EXPLAIN ANALYZE."""
+    sql = sql.compile(
+        dialect=conn.dialect, compile_kwargs={"literal_binds": True}
+    )
+    explain = sa.text(f"EXPLAIN (ANALYZE, FORMAT JSON) {sql}")
+    plan = conn.execute(explain).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]["Execution Time"]
+
+
+def main(number=5):
+    engine = sa.create_engine("postgresql://")
+    meta = sa.MetaData()
+    meta.reflect(bind=engine)
+    q = Q(meta=meta, engine=engine)
+    with engine.connect() as conn:
+        for name, query in queries(q):
+            op = plan(query.syn, meta, optimize=False)
+            jsonb = compile(
+                trampoline(optimizer.rewrite(op, optimizer.Context()))
+            )
+            json_ = compile(optimizer.optimize(op))
+            print(name)
+            for label, sql in [("jsonb", jsonb), ("json", json_)]:
+                ms = min(execution_time(conn, sql) for _ in range(number))
+                print(f"  {label:<6} {ms:10.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
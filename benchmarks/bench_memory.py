@@ -0,0 +1,44 @@
+"""
+
+    benchmarks.bench_memory
+    =======================
+
+    Memory taken by cached plans of the test suite queries.
+
+    Run with::
+
+        python -m benchmarks.bench_memory
+
+"""
+
+import tracemalloc
+
+from qc0 import Q
+from qc0.plan import plan
+
+from .schema import tpch_meta
+from .corpus import QUERIES
+
+
+def main():
+    meta = tpch_meta()
+    q = Q(meta=meta, engine=None)
+    syns = [make(q).syn for make in QUERIES.values()]
+    # warm up caches so that only plans are measured
+    for syn in syns:
+        plan(syn, meta)
+
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    plans = [plan(syn, meta) for syn in syns]
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    size = after - before
+    print(f"{len(plans)} cached plans")
+    print(f"  {'total':<20} {size / 1024:10.1f}KiB")
+    print(f"  {'per plan':<20} {size / len(plans):10.0f}B")
+
+
+if __name__ == "__main__":
+    main()
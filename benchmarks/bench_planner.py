@@ -0,0 +1,46 @@
+"""
+
+    benchmarks.bench_planner
+    ========================
+
+    Planning time for the test suite queries, with and without struct type
+    checking.
+
+    Run with::
+
+        python -m benchmarks.bench_planner
+
+"""
+
+import timeit
+
+from qc0 import Q
+from qc0.base import set_typecheck
+from qc0.plan import plan
+
+from .schema import tpch_meta
+from .corpus import QUERIES
+
+
+def main(number=20):
+    meta = tpch_meta()
+    q = Q(meta=meta, engine=None)
+    syns = [make(q).syn for make in QUERIES.values()]
+
+    def run():
+        for syn in syns:
+            plan(syn, meta)
+
+    print(f"planning {len(syns)} queries")
+    for typecheck in (True, False):
+        prev = set_typecheck(typecheck)
+        try:
+            seconds = timeit.timeit(run, number=number) / number
+        finally:
+            set_typecheck(prev)
+        label = "with type checks" if typecheck else "without type checks"
+        print(f"  {label:<30} {seconds * 1000:10.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+
+    benchmarks.bench_syntax
+    =======================
+
+    Memory taken by a large generated set of query syntax trees.
+
+    Run with::
+
+        python -m benchmarks.bench_syntax
+
+"""
+
+import random
+import dataclasses
+import tracemalloc
+
+from qc0 import Q
+from qc0.syntax import Syn, Field
+
+
+TABLES = {
+    "region": ["name", "comment"],
+    "nation": ["name", "comment"],
+    "customer": ["name", "address", "phone", "acctbal", "mktsegment"],
+    "supplier": ["name", "address", "phone", "acctbal"],
+}
+NAVS = {
+    "region": ["nation"],
+    "nation": ["region", "customer", "supplier"],
+    "customer": ["nation"],
+    "supplier": ["nation"],
+}
+
+
+def generate(q, rng):
+    """ Generate a random query in a TPC-H like schema."""
+    table = rng.choice(list(TABLES))
+    query = q.nav(table)
+    if rng.random() < 0.7:
+        column = rng.choice(TABLES[table])
+        query = query.filter(q.nav(column).length() > rng.randrange(10))
+    fields = {}
+    for column in rng.sample(TABLES[table], 2):
+        fields[column] = q.nav(column)
+    nav = rng.choice(NAVS[table])
+    fields[nav] = q.nav(nav).nav(rng.choice(TABLES[nav]))
+    query = query.select(**fields)
+    if rng.random() < 0.5:
+        query = query.take(rng.randrange(1, 10))
+    return query.syn
+
+
+def copy(syn):
+    """ Copy syntax tree bypassing interning."""
+    if isinstance(syn, (list, tuple)):
+        return type(syn)(copy(v) for v in syn)
+    if isinstance(syn, dict):
+        return {k: copy(v) for k, v in syn.items()}
+    if isinstance(syn, (Syn, Field)):
+        values = {
+            f.name: copy(getattr(syn, f.name)) for f in dataclasses.fields(syn)
+        }
+        return type.__call__(type(syn), **values)
+    return syn
+
+
+def measure(make):
+    tracemalloc.start()
+    value = make()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return value, size
+
+
+def main(number=5000):
+    q = Q(meta=None, engine=None)
+    rng = random.Random(0)
+
+    syns, interned = measure(lambda: [generate(q, rng) for _ in range(number)])
+    _, copied = measure(lambda: [copy(syn) for syn in syns])
+
+    print(f"{number} generated queries, {len(set(syns))} distinct")
+    print(f"  {'interned':<20} {interned / 1024:10.1f}KiB")
+    print(f"  {'not interned':<20} {copied / 1024:10.1f}KiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+"""
+
+    benchmarks.corpus
+    =================
+
+    Queries from the test suite, used as a corpus by benchmarks.
+
+"""
+
+from datetime import date
+
+QUERIES = {
+    "nav_nation": lambda q: q.nation,
+    "nav_nation_name": lambda q: q.nation.name,
+    "nav_nation_region_name": lambda q: q.nation.region.name,
+    "nav_customer_nation_region_name": lambda q: (
+        q.customer.nation.region.name
+    ),
+    "compose_nation_name": lambda q: q.nation >> q.name,
+    "compose_nation_region_name": lambda q: q.nation >> q.region >> q.name,
+    "compose_nation_select": lambda q: (
+        q.nation >> q.select(nation_name=q.name, region_name=q.region.name)
+    ),
+    "select_nav_select": lambda q: (
+        q.nation.select(name=q.name, comment=q.comment)
+    ),
+    "select_tables": lambda q: q.select(region=q.region),
+    "select_nav_select_nav_only": lambda q: (
+        q.nation.select(region_name=q.region.name)
+    ),
+    "select_nav_select_nav_multi": lambda q: (
+        q.nation.select(
+            name=q.name,
+            region_name=q.region.name,
+            region_comment=q.region.comment,
+        )
+    ),
+    "select_nav_select_nav_select": lambda q: (
+        q.nation.select(region=q.region.select(name=q.name))
+    ),
+    "select_select_nav_one": lambda q: q.select(region_names=q.region.name),
+    "select_select_nav_nav": lambda q: (
+        q.select(region_names=q.nation.region.name)
+    ),
+    "select_select_multiple": lambda q: (
+        q.select(nation_names=q.nation.name, region_names=q.region.name)
+    ),
+    "select_nav_select_nav_column": lambda q: (
+        q.region.select(region_name=q.name).region_name
+    ),
+    "select_nav_select_nav_table": lambda q: (
+        q.region.select(n=q.nation).n.name
+    ),
+    "select_nav_select_select": lambda q: (
+        q.region.select(n=q.nation.name).select(nn=q.n)
+    ),
+    "select_nav_select_select_select": lambda q: (
+        q.region.select(n=q.nation.name).select(nn=q.n).select(nnn=q.nn)
+    ),
+    "select_nav_select_select_select_nav": lambda q: (
+        q.region.select(n=q.nation.name).select(nn=q.n).select(nnn=q.nn).nnn
+    ),
+    "select_link_nav": lambda q: q.region.select(n=q.nation).n,
+    "select_backlink_nav": lambda q: q.nation.select(r=q.region).r,
+    "select_backlink_nav_column": lambda q: (
+        q.nation.select(r=q.region).r.name
+    ),
+    "back_nav_region_nation": lambda q: q.region.nation,
+    "back_nav_region_nation_name": lambda q: q.region.nation.name,
+    "back_nav_region_nation_customer": lambda q: (
+        q.region.nation.customer.name
+    ),
+    "select_back_nav": lambda q: q.region.select(nation_names=q.nation.name),
+    "select_back_nav_nested": lambda q: (
+        q.region.select(
+            region_name=q.name,
+            nations=q.nation.select(
+                nation_name=q.name,
+                customer_names=q.customer.name,
+            ),
+        )
+    ),
+    "count_region": lambda q: q.region.count(),
+    "count_region_via_opend": lambda q: q.region >> q.count(),
+    "count_nation_region": lambda q: q.nation.region.count(),
+    "count_region_select_nation_count": lambda q: (
+        q.region.select(nation_count=q.nation.count())
+    ),
+    "take_region": lambda q: q.region.take(2),
+    "take_region_nation": lambda q: q.region.nation.take(2),
+    "take_region_x_nation": lambda q: q.region.take(2).nation,
+    "take_region_select_nation": lambda q: (
+        q.region.select(nation=q.nation.name.take(2))
+    ),
+    "literal_string": lambda q: q.val("Hello"),
+    "literal_integer": lambda q: q.val(42),
+    "literal_boolean": lambda q: q.val(True),
+    "literal_composition_with_another_literal": lambda q: (
+        q.val(True) >> q.val(False)
+    ),
+    "literal_composition_with_query_via_op": lambda q: q.region >> True,
+    "literal_composition_with_query_via_dot": lambda q: q.region.val(True),
+    "filter_region_true": lambda q: q.region.filter(False),
+    "filter_region_by_name": lambda q: q.region.filter(q.name == "AFRICA"),
+    "filter_region_by_name_then_nav": lambda q: (
+        q.region.filter(q.name == "AFRICA").name
+    ),
+    "filter_region_by_name_then_select": lambda q: (
+        q.region.filter(q.name == "AFRICA").select(
+            name=q.name, nation_names=q.nation.name
+        )
+    ),
+    "filter_nation_by_region_name": lambda q: (
+        q.nation.filter(q.region.name == "AFRICA")
+    ),
+    "filter_nation_by_region_name_then_nav_column": lambda q: (
+        q.nation.filter(q.region.name == "AFRICA").name
+    ),
+    "filter_customer_by_region_name_then_nav_column": lambda q: (
+        q.customer.filter(q.nation.region.name == "AFRICA").name
+    ),
+    "filter_customer_by_region_name_then_count": lambda q: (
+        q.customer.filter(q.nation.region.name == "AFRICA").count()
+    ),
+    "filter_customer_nation_by_region_name_then_nav_column": lambda q: (
+        q.customer.nation.filter(q.region.name == "AFRICA").name
+    ),
+    "filter_region_by_nation_count": lambda q: (
+        q.region.filter(q.nation.count() == 5)
+    ),
+    "filter_multiple": lambda q: (
+        q.region.filter(q.name == "AFRICA").filter(q.name != "EUROPE")
+    ),
+    "add_string_literals": lambda q: q.val("Hello, ") + "World!",
+    "add_integer_literals": lambda q: q.val(40) + 2,
+    "add_columns": lambda q: (
+        q.nation.select(full_name=q.name + " IN " + q.region.name)
+    ),
+    "add_lateral_columns": lambda q: (
+        q.region.select(names=q.nation.name + "!")
+    ),
+    "add_columns_of_relok": lambda q: q.region.name + "!",
+    "sub_integer_literals": lambda q: q.val(44) - 2,
+    "mul_integer_literals": lambda q: q.val(22) * 2,
+    "truediv_integer_literals": lambda q: q.val(88) / 2,
+    "and_literals": lambda q: q.val(True) & False,
+    "or_literals": lambda q: q.val(True) | False,
+    "date_literal": lambda q: q.val(date(2020, 1, 2)),
+    "date_literal_nav": lambda q: q.val(date(2020, 1, 2)).year,
+    "date_column_nav": lambda q: q.order.orderdate.year,
+    "date_column_select": lambda q: q.order.select(date=q.orderdate.year),
+    "date_column_nav_select": lambda q: (
+        q.lineitem.select(date=q.order.orderdate.year)
+    ),
+    "json_literal": lambda q: q.val({"hello": ["world"]}),
+    "json_literal_nav": lambda q: q.val({"hello": ["world"]}).hello,
+    "json_literal_nested_nav": lambda q: (
+        q.val({"hello": {"world": "YES"}}).hello.world
+    ),
+    "select_filter_end": lambda q: (
+        q.region.select(n=q.name).filter(q.n == "AFRICA")
+    ),
+    "group_nation_by_region_select": lambda q: (
+        q.nation.group(reg=q.region.name).select(reg=q.reg)
+    ),
+    "group_region_by_nation_select": lambda q: (
+        q.region.group(reg=q.nation.name.count()).select(field=q.reg)
+    ),
+    "group_nation_by_region_select_aggr": lambda q: (
+        q.nation.group(reg=q.region.name).select(
+            ref=q.reg,
+            count=q._.name.count(),
+        )
+    ),
+    "group_nation_by_region_select_aggr_link": lambda q: (
+        q.nation.group(reg=q.region.name).select(
+            ref=q.reg,
+            customer_count=q._.customer.count(),
+        )
+    ),
+    "group_nation_by_region_select_aggr_col_and_link": lambda q: (
+        q.nation.group(reg=q.region.name).select(
+            ref=q.reg,
+            nation_count=q._.name.count(),
+            customer_count=q._.customer.count(),
+        )
+    ),
+    "group_nation_by_region_select_aggr_filter": lambda q: (
+        q.nation.group(reg=q.region.name).select(
+            reg=q.reg,
+            count=q._.filter(q.name == "KENYA").count(),
+        )
+    ),
+    "group_nation_by_region_select_aggr_array": lambda q: (
+        q.nation.group(reg=q.region.name).select(reg=q.reg, all=q._.name)
+    ),
+    "group_then_nav_to_field": lambda q: (
+        q.nation.group(reg=q.region.name).reg
+    ),
+    "group": lambda q: q.nation.group(reg=q.region.name),
+    "group_select_nav": lambda q: q.nation.group(n=q.region.name)._.count(),
+    "group_select_nav_name": lambda q: (
+        q.nation.group(n=q.region.name)._.name
+    ),
+    "group_select_nav_link_name": lambda q: (
+        q.nation.group(n=q.region.name)._.region.name
+    ),
+    "group_binop_aggr": lambda q: (
+        q.region.group(len=q.name).select(names=q._.name + "!")
+    ),
+    "nested_group": lambda q: (
+        q.nation.group(r1=q.name.substring(1, 1)).select(
+            r1=q.r1,
+            names=q._.name,
+            nested=(
+                q._.group(r2=q.name.substring(1, 2)).select(
+                    r2=q.r2, names2=q._.name
+                )
+            ),
+        )
+    ),
+    "substring_rel": lambda q: q.region.name.substring(1, 2),
+    "substring_expr": lambda q: (
+        q.region.select(silly_abbr=q.name.substring(1, 2))
+    ),
+    "substring_rel_non_expr": lambda q: (
+        q.region.name.take(2).substring(1, 2)
+    ),
+    "group_by_link": lambda q: q.nation.group(n=q.region),
+    "around": lambda q: (
+        q.region.filter(q.name.substring(1, 1) == "A").select(
+            n=q.name, nn=q.around().count()
+        )
+    ),
+    "around_through": lambda q: (
+        q.nation.select(
+            n=q.name,
+            nn=q.around(q.region).filter(q.region.name == "EUROPE").count(),
+        )
+    ),
+    "filter_take": lambda q: (
+        q.region.filter(q.name.substring(1, 1) == "A").take(1)
+    ),
+    "take_filter": lambda q: (
+        q.region.take(1).filter(q.name.substring(1, 1) == "A")
+    ),
+    "take_take": lambda q: q.region.take(3).take(1),
+    "take_sort": lambda q: q.region.take(3).sort(q.name.desc()),
+    "sort_take": lambda q: q.region.sort(q.name.desc()).take(3),
+    "filter_sort": lambda q: (
+        q.region.filter(q.name.substring(1, 1) == "A").sort(q.name.desc())
+    ),
+    "sort_filter": lambda q: (
+        q.region.sort(q.name.desc()).filter(q.name.substring(1, 1) == "A")
+    ),
+    "sort": lambda q: q.region.sort(q.name.length()).name,
+    "sort_by_aggr": lambda q: (
+        q.region.select(
+            num_customers=q.nation.customer.count(), name=q.name
+        ).sort(q.num_customers)
+    ),
+    "sort_then_nav": lambda q: (
+        q.nation.select(region=q.region.name, name=q.name).sort(q.region)
+    ),
+    "select_link_then_take": lambda q: (
+        q.nation.select(region=q.region.name, c=q.customer.count()).take(10)
+    ),
+    "group_by_none": lambda q: (
+        q.region.group().select(
+            region_count=q._.count(),
+            nation_count=q._.nation.count(),
+        )
+    ),
+    "select_nav_agg": lambda q: q.region.select(c=q.nation.count()).c,
+    "select_nav_agg_expr": lambda q: (
+        q.region.select(c=q.nation.count() + 1).c
+    ),
+}
@@ -0,0 +1,143 @@
+"""
+
+    benchmarks.schema
+    =================
+
+    Synthetic schemas for benchmarks which don't need a database.
+
+"""
+
+import sqlalchemy as sa
+
+
+def make_meta(size=500):
+    """
+    Make a schema of ``size`` tables.
+
+    Each table ``t_N`` references the previous one ``t_{N-1}`` and the root
+    ``t_0`` table.
+    """
+    meta = sa.MetaData()
+    for idx in range(size):
+        columns = [
+            sa.Column("id", sa.Integer, primary_key=True),
+            sa.Column("name", sa.String),
+            sa.Column("created", sa.Date),
+        ]
+        if idx > 0:
+            columns.append(
+                sa.Column(
+                    "parent_id", sa.Integer, sa.ForeignKey(f"t_{idx - 1}.id")
+                )
+            )
+        if idx > 1:
+            columns.append(
+                sa.Column("root_id", sa.Integer, sa.ForeignKey("t_0.id"))
+            )
+        sa.Table(f"t_{idx}", meta, *columns)
+    return meta
+
+
+def tpch_meta():
+    """ Make the TPC-H schema the test suite is run against."""
+    meta = sa.MetaData()
+    Integer, String, Numeric, Date = sa.Integer, sa.String, sa.Numeric, sa.Date
+
+    def fk(name, target):
+        return sa.Column(name, Integer, sa.ForeignKey(target), nullable=False)
+
+    sa.Table(
+        "region",
+        meta,
+        sa.Column("id", Integer, unique=True, nullable=False),
+        sa.Column("name", String, primary_key=True),
+        sa.Column("comment", String),
+    )
+    sa.Table(
+        "nation",
+        meta,
+        sa.Column("id", Integer, unique=True, nullable=False),
+        sa.Column("name", String, primary_key=True),
+        fk("region_id", "region.id"),
+        sa.Column("comment", String),
+    )
+    sa.Table(
+        "customer",
+        meta,
+        sa.Column("id", Integer, primary_key=True),
+        sa.Column("name", String),
+        sa.Column("address", String),
+        fk("nation_id", "nation.id"),
+        sa.Column("phone", String),
+        sa.Column("acctbal", Numeric),
+        sa.Column("mktsegment", String),
+        sa.Column("comment", String),
+    )
+    sa.Table(
+        "supplier",
+        meta,
+        sa.Column("id", Integer, primary_key=True),
+        sa.Column("name", String),
+        sa.Column("address", String),
+        fk("nation_id", "nation.id"),
+        sa.Column("phone", String),
+        sa.Column("acctbal", Numeric),
+        sa.Column("comment", String),
+    )
+    sa.Table(
+        "part",
+        meta,
+        sa.Column("id", Integer, primary_key=True),
+        sa.Column("name", String),
+        sa.Column("mfgr", String),
+        sa.Column("brand", String),
+        sa.Column("type", String),
+        sa.Column("size", Integer),
+        sa.Column("container", String),
+        sa.Column("retailprice", Numeric),
+        sa.Column("comment", String),
+    )
+    sa.Table(
+        "partsupp",
+        meta,
+        sa.Column("id", Integer, primary_key=True),
+        fk("part_id", "part.id"),
+        fk("supplier_id", "supplier.id"),
+        sa.Column("availqty", Integer),
+        sa.Column("supplycost", Numeric),
+        sa.Column("comment", String),
+    )
+    sa.Table(
+        "order",
+        meta,
+        sa.Column("id", Integer, primary_key=True),
+        fk("customer_id", "customer.id"),
+        sa.Column("orderstatus", String),
+        sa.Column("totalprice", Numeric),
+        sa.Column("orderdate", Date),
+        sa.Column("orderpriority", String),
+        sa.Column("clerk", String),
+        sa.Column("shippriority", Integer),
+        sa.Column("comment", String),
+    )
+    sa.Table(
+        "lineitem",
+        meta,
+        sa.Column("id", Integer, primary_key=True),
+        fk("order_id", "order.id"),
+        fk("partsupp_id", "partsupp.id"),
+        sa.Column("linenumber", Integer),
+        sa.Column("quantity", Numeric),
+        sa.Column("extendedprice", Numeric),
+        sa.Column("discount", Numeric),
+        sa.Column("tax", Numeric),
+        sa.Column("returnflag", String),
+        sa.Column("linestatus", String),
+        sa.Column("shipdate", Date),
+        sa.Column("commitdate", Date),
+        sa.Column("receiptdate", Date),
+        sa.Column("shipinstruct", String),
+        sa.Column("shipmode", String),
+        sa.Column("comment", String),
+    )
+    return meta
@@ -1,5 +1,6 @@
 from .q import Q
+from .route import Routing, Hedging
 
 __version__ = "0.1.0"
 
-__all__ = ("Q",)
+__all__ = ("Q", "Routing", "Hedging")
@@ -1,3 +1,5 @@
+import os
+import types
 import dataclasses
 import collections.abc
 import yaml
@@ -6,20 +8,52 @@ import typing
 
 
 class StructMeta(type):
+    # Whether to generate structural __eq__ and __hash__.
+    eq = True
+
     def __new__(mcs, name, bases, fields):
+        fields = dict(fields)
+        # Make sure zero argument super() refers to the final class.
+        classcell = fields.pop("__classcell__", None)
         cls = super().__new__(mcs, name, bases, fields)
-        return dataclasses.dataclass(frozen=True)(cls)
+        cls = dataclasses.dataclass(frozen=True, eq=mcs.eq)(cls)
+        # Now re-create the class with __slots__ for its own fields (and
+        # without defaults as class attributes, dataclass has already baked
+        # them into __init__) so instances don't carry __dict__.
+        inherited = set()
+        for base in bases:
+            inherited.update(getattr(base, "__dataclass_fields__", ()))
+        slots = tuple(fields.get("__slots__", ())) + tuple(
+            f.name for f in dataclasses.fields(cls) if f.name not in inherited
+        )
+        namespace = dict(cls.__dict__)
+        for k in ("__dict__", "__weakref__", *slots):
+            namespace.pop(k, None)
+        namespace["__slots__"] = slots
+        if classcell is not None:
+            namespace["__classcell__"] = classcell
+        return super().__new__(mcs, name, bases, namespace)
 
 
 class Struct(metaclass=StructMeta):
+    __slots__ = ()
+
     def replace(self, **values):
         return dataclasses.replace(self, **values)
 
+    def __getstate__(self):
+        return [getattr(self, f.name) for f in dataclasses.fields(self)]
+
+    def __setstate__(self, state):
+        for f, v in zip(dataclasses.fields(self), state):
+            object.__setattr__(self, f.name, v)
+
     def __post_init__(self):
+        if not _typecheck:
+            return
         errors = []
-        for k, t in typing.get_type_hints(self.__class__).items():
-            v = getattr(self, k)
-            errors = errors + check(t, v, f"key `{k}` ")
+        for k, validate in validators(self.__class__):
+            errors.extend(validate(getattr(self, k), f"key `{k}` "))
         if errors:
             errors = [
                 f"Unable to create `{self.__class__.__name__}` struct:"
@@ -28,7 +62,7 @@ class Struct(metaclass=StructMeta):
 
     def __yaml__(self):
         fields = {}
-        for k in typing.get_type_hints(self.__class__):
+        for k in type_hints(self.__class__):
             v = getattr(self, k)
             if isinstance(v, Struct):
                 v = v
@@ -43,46 +77,116 @@ class Struct(metaclass=StructMeta):
         return yaml.dump(self)
 
 
+# Structs are type checked on construction unless QC0_TYPECHECK=0 is set in
+# environment (or set_typecheck(False) is called).
+_typecheck = os.environ.get("QC0_TYPECHECK", "1") != "0"
+
+
+def set_typecheck(enabled: bool) -> bool:
+    """
+    Enable or disable type checking of structs on construction.
+
+    Returns the previous setting.
+    """
+    global _typecheck
+    prev, _typecheck = _typecheck, enabled
+    return prev
+
+
+@functools.lru_cache(maxsize=None)
+def type_hints(cls):
+    """ Resolved type hints of a struct class."""
+    return typing.get_type_hints(cls)
+
+
+@functools.lru_cache(maxsize=None)
+def validators(cls):
+    """ Validators for each of the struct class fields."""
+    return tuple((k, validator(t)) for k, t in type_hints(cls).items())
+
+
 def check(t, v, prefix):
-    errors = []
+    return validator(t)(v, prefix)
+
+
+def no_errors(v, prefix):
+    return []
+
+
+@functools.lru_cache(maxsize=None)
+def validator(t):
+    """
+    Compile a function which checks a value against type ``t``.
+
+    The function receives a value and a prefix for error messages and returns
+    a list of errors.
+    """
     t_orig = getattr(t, "__origin__", None)
     if t is typing.Any:
-        return errors
+        return no_errors
     if t_orig is dict:
-        if not isinstance(v, dict):
-            errors.append(f"{prefix}expected `{t}` received `{type(v)}`")
-            return errors
         kt, vt = t.__args__
-        for k, kv in v.items():
-            errors = (
-                errors
-                + check(kt, k, f"{prefix}key `{k}` ")
-                + check(vt, kv, f"{prefix}value at `{k}` ")
-            )
-        return errors
-    if t_orig is list:
-        if not isinstance(v, (list, tuple)):
-            errors.append(f"{prefix}expected `{t}` received `{type(v)}`")
+        kcheck, vcheck = validator(kt), validator(vt)
+        if kcheck is no_errors and vcheck is no_errors:
+            kcheck = vcheck = None
+
+        def check_dict(v, prefix):
+            if not isinstance(v, dict):
+                return [f"{prefix}expected `{t}` received `{type(v)}`"]
+            if kcheck is None:
+                return []
+            errors = []
+            for k, kv in v.items():
+                errors.extend(kcheck(k, f"{prefix}key `{k}` "))
+                errors.extend(vcheck(kv, f"{prefix}value at `{k}` "))
             return errors
+
+        return check_dict
+    if t_orig is list:
         (vt,) = t.__args__
-        for idx, iv in enumerate(v):
-            errors = errors + check(vt, iv, f"{prefix}value at `{idx}` ")
-        return errors
-    if t_orig is typing.Union:
-        for a in t.__args__:
-            a_errors = check(a, v, prefix)
-            if not a_errors:
+        vcheck = validator(vt)
+        if vcheck is no_errors:
+            vcheck = None
+
+        def check_list(v, prefix):
+            if not isinstance(v, (list, tuple)):
+                return [f"{prefix}expected `{t}` received `{type(v)}`"]
+            if vcheck is None:
                 return []
-            errors = errors + a_errors
-        return errors
+            errors = []
+            for idx, iv in enumerate(v):
+                errors.extend(vcheck(iv, f"{prefix}value at `{idx}` "))
+            return errors
+
+        return check_list
+    if t_orig is typing.Union:
+        checks = tuple(validator(a) for a in t.__args__)
+
+        def check_union(v, prefix):
+            errors = []
+            for check in checks:
+                a_errors = check(v, prefix)
+                if not a_errors:
+                    return []
+                errors.extend(a_errors)
+            return errors
+
+        return check_union
     if t_orig is collections.abc.Callable:
-        if not callable(v):
-            errors.append(f"{prefix}expected `{t}` received `{type(v)}`")
-        return errors
-    if not isinstance(v, t):
-        errors.append(f"{prefix}expected `{t}` received `{type(v)}`")
-        return errors
-    return errors
+
+        def check_callable(v, prefix):
+            if not callable(v):
+                return [f"{prefix}expected `{t}` received `{type(v)}`"]
+            return []
+
+        return check_callable
+
+    def check_instance(v, prefix):
+        if not isinstance(v, t):
+            return [f"{prefix}expected `{t}` received `{type(v)}`"]
+        return []
+
+    return check_instance
 
 
 def Struct_representer(dumper, self):
@@ -95,6 +199,51 @@ def Struct_representer(dumper, self):
 yaml.add_multi_representer(Struct, Struct_representer)
 
 
+def trampoline(gen):
+    """
+    Run a generator based computation without growing the Python stack.
+
+    A computation is a generator which yields sub-computations and receives
+    their results back (``value = yield compute(...)``). Yielding (or
+    returning) anything other than a generator is the same as yielding an
+    already computed value, so plain functions can be used where there is
+    nothing to recurse into.
+    """
+    generator = types.GeneratorType
+    if type(gen) is not generator:
+        return gen
+    stack = [gen]
+    push, pop = stack.append, stack.pop
+    value = None
+    error = None
+    while stack:
+        try:
+            if error is not None:
+                thrown, error = error, None
+                sub = stack[-1].throw(thrown)
+            else:
+                sub = stack[-1].send(value)
+        except StopIteration as e:
+            pop()
+            value = e.value
+            if type(value) is generator:
+                # Tail call.
+                push(value)
+                value = None
+        except BaseException as e:
+            pop()
+            if not stack:
+                raise
+            error = e
+        else:
+            if type(sub) is generator:
+                push(sub)
+                value = None
+            else:
+                value = sub
+    return value
+
+
 def cached(f):
     return functools.lru_cache(maxsize=None, typed=True)(f)
 
@@ -0,0 +1,121 @@
+"""
+
+    qc0.catalog
+    ===========
+
+    This module describes database schema in a form suitable for planning.
+
+"""
+
+from __future__ import annotations
+
+import weakref
+from typing import Dict, List, Any
+
+import sqlalchemy as sa
+
+from .base import Struct
+from .scope import type_scope
+from .route import execute
+
+
+class TableInfo(Struct):
+    """
+    Everything planner needs to know about a table.
+
+    Foreign keys are indexed by the name of the table on the other side of
+    the relationship.
+    """
+
+    table: sa.Table
+    columns: Dict[str, sa.Column]
+    primary_key: List[sa.Column]
+    foreign_keys: Dict[str, sa.ForeignKey]
+    rev_foreign_keys: Dict[str, sa.ForeignKey]
+    scopes: Dict[str, Any]
+
+    def __yaml__(self):
+        return {"table": str(self.table.name)}
+
+
+class Catalog(Struct):
+    """
+    An immutable index of database schema.
+
+    It is built once from ``sqlalchemy.MetaData`` so that planning doesn't
+    need to scan the metadata on each navigation.
+    """
+
+    tables: Dict[str, TableInfo]
+
+    def info(self, table: sa.Table) -> TableInfo:
+        return self.tables[table.key]
+
+    @classmethod
+    def make(cls, meta: sa.MetaData) -> Catalog:
+        rev_foreign_keys = {key: {} for key in meta.tables}
+        for table in meta.tables.values():
+            for fk in table.foreign_keys:
+                rev = rev_foreign_keys.get(fk.column.table.key)
+                if rev is not None:
+                    rev[fk.parent.table.name] = fk
+        tables = {}
+        for key, table in meta.tables.items():
+            tables[key] = TableInfo(
+                table=table,
+                columns=dict(table.columns.items()),
+                primary_key=list(table.primary_key.columns),
+                foreign_keys={
+                    fk.column.table.name: fk for fk in table.foreign_keys
+                },
+                rev_foreign_keys=rev_foreign_keys[key],
+                scopes={
+                    name: type_scope(column.type)
+                    for name, column in table.columns.items()
+                },
+            )
+        return cls(tables=tables)
+
+    @classmethod
+    def of(cls, meta: sa.MetaData) -> Catalog:
+        """
+        Catalog for ``meta``.
+
+        The catalog is built on first use and is rebuilt if tables of ``meta``
+        were added, removed or replaced since then. Use ``invalidate()`` after
+        changing columns or foreign keys of existing tables (e.g. with
+        ``extend_existing=True``).
+        """
+        tables = list(meta.tables.values())
+        cached = _catalogs.get(meta)
+        if cached is not None and len(cached[0]) == len(tables):
+            if all(a is b for a, b in zip(cached[0], tables)):
+                return cached[1]
+        catalog = cls.make(meta)
+        _catalogs[meta] = tables, catalog
+        return catalog
+
+    @classmethod
+    def invalidate(cls, meta: sa.MetaData):
+        """ Rebuild catalog for ``meta`` on its next use."""
+        _catalogs.pop(meta, None)
+
+
+_catalogs = weakref.WeakKeyDictionary()
+
+
+def analyze(meta: sa.MetaData, engine):
+    """
+    Store row count estimates for tables of ``meta`` as ``table.info["rows"]``.
+
+    Estimates come from PostgreSQL statistics and are used by the compiler to
+    choose between different ways to compile a query.
+    """
+    sql = sa.text(
+        "SELECT reltuples FROM pg_class WHERE oid = to_regclass(:name)"
+    )
+    for table in meta.tables.values():
+        name = engine.dialect.identifier_preparer.format_table(table)
+        rows = execute(engine, sql.bindparams(name=name))
+        if rows and rows[0][0] is not None and rows[0][0] >= 0:
+            table.info["rows"] = int(rows[0][0])
@@ -4,14 +4,24 @@ from datetime import date  # noqa: F401
 
 @click.command()
 @click.argument("db", default="postgresql://")
-def shell(db):
+@click.option("--replica", multiple=True, help="Read replica to route to.")
+@click.option("--max-lag", type=float, help="Max replica lag (seconds).")
+def shell(db, replica, max_lag):
     from IPython.terminal.embed import embed
     from sqlalchemy import create_engine, MetaData
-    from qc0 import Q
+    from qc0 import Q, Routing
+    from qc0.catalog import analyze
 
     engine = create_engine(db)
     meta = MetaData()
     meta.reflect(bind=engine)
+    analyze(meta, engine)
+    if replica:
+        engine = Routing(
+            primary=engine,
+            replicas=[create_engine(r) for r in replica],
+            max_lag=max_lag,
+        )
     q = Q(meta=meta, engine=engine)  # NOQA
 
     embed()
@@ -1,8 +1,16 @@
+import types
+import operator
+import dataclasses
+import contextvars
 from typing import Dict, List, Any
 from functools import singledispatch
 import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import aggregate_order_by
 from sqlalchemy.sql.selectable import Selectable, Join, Alias
-from .base import Struct
+from sqlalchemy.sql.elements import _anonymous_label, Tuple
+from .base import Struct, trampoline
+from .sig import Sig, JsonAggSig
+from . import simplify as simplifier
 from .op import (
     Op,
     Rel,
@@ -24,23 +32,185 @@ from .op import (
     ExprIdentity,
     ExprConst,
     ExprApply,
+    ExprExists,
 )
 
 
-def compile(op: Op):
-    """ Compile operations into SQL."""
-    value, from_obj = op_to_sql(op, From.make(None))
-    return from_obj.to_select(value)
+def compile(op: Op, decorrelate=None, simplify=True):
+    """
+    Compile operations into SQL.
+
+    Nested aggregates are compiled either as ``LEFT JOIN LATERAL`` subqueries
+    correlated to the outer row or (if ``decorrelate`` is true) as subqueries
+    which compute aggregates for all outer rows at once, grouped by the
+    foreign key, and are joined with ``LEFT JOIN``. By default the latter is
+    used when the outer relation isn't filtered or is estimated to have more
+    than ``LARGE`` rows, or the aggregated table is estimated to have at most
+    ``LARGE`` rows (see ``catalog.analyze()``). Aggregates over the first N
+    rows of a sorted relation are decorrelated by numbering rows within each
+    group with ``row_number()`` (or with ``DISTINCT ON`` when N is 1).
+
+    If ``simplify`` is true then subqueries are merged into the enclosing
+    ``SELECT`` where it is safe (see ``qc0.simplify``).
+    """
+    token = fingerprints.set(Fingerprints())
+    decorrelate_token = decorrelation.set(decorrelate)
+    required_token = required_columns.set(referenced_columns(op))
+    try:
+        value, from_obj = trampoline(op_to_sql(op, From.make(None)))
+        sel = from_obj.to_select(value)
+        return simplifier.simplify(sel) if simplify else sel
+    finally:
+        required_columns.reset(required_token)
+        decorrelation.reset(decorrelate_token)
+        fingerprints.reset(token)
+
+
+# Number of rows from which a relation is considered large.
+LARGE = 10000
+
+
+class Fingerprints:
+    """
+    Structural fingerprints of operations.
+
+    Operations which compile to the same SQL (given the same FROM) get the
+    same fingerprint, scopes and syntax they were planned from are ignored.
+    Each distinct structure is numbered so fingerprints of nested operations
+    stay cheap to hash and compare.
+    """
+
+    # Fields which don't affect compilation.
+    skip = {Op: ("scope", "syn"), RelParent: ("parent",)}
+
+    def __init__(self):
+        self.numbers = {}
+        self.seen = {}
+
+    def of(self, op: Op) -> int:
+        return trampoline(self.compute(op))
+
+    def number(self, parts):
+        return self.numbers.setdefault(parts, len(self.numbers))
+
+    def identity(self, value):
+        # keep value around so its id isn't reused
+        self.seen.setdefault(id(value), (value, None))
+        return self.number(("id", id(value)))
+
+    def compute(self, value):
+        if isinstance(value, Struct):
+            if id(value) in self.seen:
+                return self.seen[id(value)][1]
+            skip = self.skip.get(type(value), ())
+            parts = [type(value)]
+            for f in dataclasses.fields(value):
+                if f.name not in skip:
+                    parts.append((yield self.compute(getattr(value, f.name))))
+            number = self.number(tuple(parts))
+            self.seen[id(value)] = value, number
+            return number
+        if isinstance(value, (list, tuple)):
+            parts = [list]
+            for item in value:
+                parts.append((yield self.compute(item)))
+            return self.number(tuple(parts))
+        if isinstance(value, dict):
+            parts = [dict]
+            for k, item in value.items():
+                parts.append((k, (yield self.compute(item))))
+            return self.number(tuple(parts))
+        if isinstance(value, Sig):
+            return self.number((type(value), *sorted(vars(value).items())))
+        if isinstance(value, sa.sql.expression.ColumnClause):
+            table = value.table.key if value.table is not None else None
+            return self.number((sa.Column, table, value.name))
+        if isinstance(value, sa.sql.ClauseElement):
+            return self.identity(value)
+        if isinstance(value, types.FunctionType):
+            parts = [value.__code__]
+            for cell in value.__closure__ or ():
+                parts.append((yield self.compute(cell.cell_contents)))
+            parts.append((yield self.compute(value.__defaults__)))
+            return self.number(tuple(parts))
+        if isinstance(value, types.MethodType):
+            owner = value.__self__
+            owner = owner if isinstance(owner, type) else type(owner)
+            return self.number((value.__func__, owner))
+        try:
+            return self.number((type(value), value))
+        except TypeError:
+            return self.identity(value)
+
+
+# Fingerprints of operations being compiled.
+fingerprints = contextvars.ContextVar("fingerprints", default=None)
+
+# Whether to decorrelate nested aggregates (None means decide automatically).
+decorrelation = contextvars.ContextVar("decorrelation", default=None)
+
+# Names of columns referenced by operations being compiled, by table key.
+required_columns = contextvars.ContextVar("required_columns", default=None)
+
+
+def referenced_columns(op: Op) -> Dict[str, set]:
+    """
+    Names of table columns referenced by ``op`` (including columns used to
+    join tables), indexed by table key.
+
+    Only these columns need to be selected when a relation is wrapped into a
+    subquery.
+    """
+    columns = {}
+
+    def add(table, names):
+        columns.setdefault(table.key, set()).update(names)
+
+    seen = set()
+    queue = [op]
+    while queue:
+        value = queue.pop()
+        if isinstance(value, (list, tuple)):
+            queue.extend(value)
+            continue
+        if isinstance(value, dict):
+            queue.extend(value.values())
+            continue
+        if not isinstance(value, Struct) or id(value) in seen:
+            continue
+        seen.add(id(value))
+        if isinstance(value, ExprColumn):
+            if isinstance(value.column.table, sa.Table):
+                add(value.column.table, [value.column.name])
+        elif isinstance(value, ExprIdentity):
+            table = value.table
+            pk = table.primary_key.columns or table.columns
+            add(table, [col.name for col in pk])
+        elif isinstance(value, (RelJoin, RelRevJoin)):
+            add(value.fk.parent.table, [value.fk.parent.name])
+            add(value.fk.column.table, [value.fk.column.name])
+        for f in dataclasses.fields(value):
+            if not isinstance(value, Op) or f.name not in ("scope", "syn"):
+                queue.append(getattr(value, f.name))
+    return columns
+
+
+# Compilation functions below are generators which yield the compilation of
+# nested operations instead of calling it directly (see base.trampoline), this
+# way deeply nested queries don't hit the recursion limit.
 
 
 class From(Struct):
     existing: Dict[any, Selectable]
     current: Selectable
     at: Selectable
-    where: Any = None
+    where: List[Any] = ()
     limit: Any = None
     order: Any = None
     group_by_columns: List[str] = None
+    correlate: Any = None
+    # The relation rows of ``at`` come from as ``(at, rel)``.
+    source: Any = None
 
     def __post_init__(self):
         if self.group_by_columns is None:
@@ -88,8 +258,15 @@ class From(Struct):
         return next, at
 
     def add_where(self, where):
-        where = (self.where & where) if self.where is not None else where
-        return self.replace(where=where)
+        return self.replace(where=(*self.where, where))
+
+    def filter(self, sel):
+        """ Add WHERE to ``sel`` (conjuncts are kept flat)."""
+        if self.where:
+            sel = sel.where(sa.and_(*self.where))
+        if self.correlate is not None:
+            sel = sel.correlate(self.correlate)
+        return sel
 
     def add_limit(self, limit):
         return self.replace(limit=limit)
@@ -102,20 +279,35 @@ class From(Struct):
         assert not isinstance(from_obj, Join)
         if from_obj is not None and not isinstance(from_obj, Alias):
             from_obj = from_obj.alias()
+        if from_obj is not None:
+            # SQLAlchemy populates columns of nested subqueries recursively on
+            # first access, do that as each level is built instead
+            from_obj.columns
         return From(current=from_obj, at=from_obj, existing={})
 
+    def at_columns(self):
+        """
+        Columns of ``at`` referenced by operations being compiled (or the
+        whole ``at`` if it isn't a table).
+        """
+        table = getattr(self.at, "element", None)
+        required = required_columns.get()
+        if not isinstance(table, sa.Table) or required is None:
+            return [self.at]
+        names = required.get(table.key, ())
+        columns = [c for c in self.at.columns if c.name in names]
+        # SELECT needs at least one column
+        return columns or list(self.at.columns)[:1]
+
     def to_select(self, value):
 
         cols = [*self.group_by_columns]
         if value is not None:
             cols.append(value.label("value"))
         else:
-            cols.append(self.at)
-
-        sel = sa.select(cols, from_obj=self.current)
+            cols.extend(self.at_columns())
 
-        if self.where is not None:
-            sel = sel.where(self.where)
+        sel = self.filter(sa.select(cols, from_obj=self.current))
         if self.order is not None:
             sel = sel.order_by(*self.order)
         if self.limit is not None:
@@ -124,31 +316,532 @@ class From(Struct):
 
 
 def op_to_sql(op: Op, from_obj):
+    if op.sig is not None:
+        return (yield aggregate_to_sql(op, from_obj))
     expr = None
-    inner_from_obj = rel_to_sql(op.rel, from_obj=from_obj)
+    source = from_obj.source
+    from_obj = yield rel_to_sql(op.rel, from_obj=from_obj)
+    if not isinstance(op.rel, (RelParent, RelAggregateParent)):
+        from_obj = from_obj.replace(source=(from_obj.at, op.rel))
     if op.expr is not None:
-        expr, inner_from_obj = expr_to_sql(op.expr, from_obj=inner_from_obj)
+        expr, from_obj = yield expr_to_sql(op.expr, from_obj=from_obj)
+    return expr, from_obj.replace(source=source)
+
+
+def aggregate_to_sql(op: Op, from_obj):
+    key = aggregate_key(op, from_obj)
+    if key is not None and key in from_obj.existing:
+        return from_obj.existing[key], from_obj
+    window = around_window(op, from_obj)
+    if window is not None:
+        at = from_obj.at
+        filters, partition = window
+        value, from_obj = yield aggregate_to_kernel(
+            op, filters, from_obj, window=partition
+        )
+        if key is not None:
+            from_obj = from_obj.replace(
+                existing={**from_obj.existing, key: value}
+            )
+        return value, from_obj.replace(at=at)
+    (value,), from_obj = yield aggregates_to_sql([op], from_obj)
+    return value, from_obj
+
+
+def around_window(op: Op, from_obj):
+    """
+    Check if aggregate ``op`` over ``around()`` the current row can be
+    computed as a window function over the rows of the current query.
+
+    Returns filters of the aggregated rows and the columns to partition by
+    (``None`` if a window function can't be used).
+    """
+    if from_obj.source is None:
+        return None
+    at, source = from_obj.source
+    if at is not from_obj.at or not isinstance(base_rel(source), RelTable):
+        return None
+    if (
+        from_obj.limit is not None
+        or from_obj.group_by_columns
+        or from_obj.correlate is not None
+        or not preserves_rows(from_obj.current, at)
+    ):
+        return None
+    if not is_row_expr(op.expr):
+        return None
+    filters, rel = [], op.rel
+    while True:
+        if not all(is_row_expr(expr) for expr in filters):
+            return None
+        if isinstance(rel, RelParent):
+            # around() the current row: all rows of the query
+            return filters, ()
+        if (
+            isinstance(rel, RelRevJoin)
+            and isinstance(rel.rel, RelJoin)
+            and isinstance(rel.rel.rel, RelAroundParent)
+            and rel.fk is rel.rel.fk
+            and isinstance(source, RelTable)
+            and source.table is rel.fk.parent.table
+            and not from_obj.where
+        ):
+            # around(link) the current row: all rows of the table with the
+            # same link
+            return filters, (at.columns[rel.fk.parent.name],)
+        if not isinstance(rel, RelFilter):
+            return None
+        filters.append(rel.expr)
+        rel = rel.rel
+
+
+def preserves_rows(current, at) -> bool:
+    """
+    Check if joins in ``current`` keep each row of ``at`` exactly once: they
+    are lookups of rows by foreign keys or aggregates (which compile to
+    lateral subqueries of a single row).
+    """
+    while isinstance(current, Join):
+        if isinstance(current.right, sa.sql.selectable.Lateral):
+            if not current.isouter:
+                return False
+        elif not is_lookup(current) and not is_grouped_lookup(current):
+            return False
+        current = current.left
+    return current is at
+
+
+def is_lookup(join: Join) -> bool:
+    condition = join.onclause
+    if not isinstance(condition, sa.sql.elements.BinaryExpression):
+        return False
+    if condition.operator is not operator.eq:
+        return False
+    left, right = table_column(condition.left), table_column(condition.right)
+    if left is None or right is None:
+        return False
+    if left.nullable and not join.isouter:
+        return False
+    # foreign keys reference unique columns
+    return any(fk.column is right for fk in left.foreign_keys)
+
+
+def is_grouped_lookup(join: Join) -> bool:
+    """ Check if ``join`` outer joins a subquery on all its ``GROUP BY`` keys."""
+    sel = join.right
+    while isinstance(sel, Alias):
+        sel = sel.element
+    if not join.isouter or not isinstance(sel, sa.sql.Select):
+        return False
+    keys = [getattr(c, "name", None) for c in sel._group_by_clause.clauses]
+    if not keys or None in keys:
+        return False
+    joined = set()
+    for node in sa.sql.visitors.iterate(join.onclause, {}):
+        if isinstance(node, sa.sql.elements.BinaryExpression):
+            if node.operator is operator.eq:
+                for column in (node.left, node.right):
+                    if getattr(column, "table", None) is join.right:
+                        joined.add(column.name)
+    return set(keys) <= joined
+
+
+def table_column(column):
+    """ Column of the table ``column`` (of a table alias) refers to."""
+    table = getattr(column, "table", None)
+    element = getattr(table, "element", None)
+    if not isinstance(element, sa.Table):
+        return None
+    return element.columns.get(column.name)
+
+
+def base_rel(rel: Rel) -> Rel:
+    """ Relation ``rel`` starts with."""
+    while hasattr(rel, "rel"):
+        rel = rel.rel
+    return rel
+
+
+def aggregate_key(op: Op, from_obj):
+    """
+    Key which identifies aggregate ``op`` computed for the current row.
+
+    Identical aggregates over the same row are computed once.
+    """
+    if from_obj.at is None or fingerprints.get() is None:
+        return None
+    if not is_correlated(op.rel):
+        return None
+    return ("aggregate", from_obj.at, fingerprints.get().of(op))
+
+
+def aggregates_to_sql(ops: List[Op], from_obj):
+    """ Compile aggregates ``ops`` over the same relation in one subquery."""
+    keys = [aggregate_key(op, from_obj) for op in ops]
+    uncorrelated = uncorrelate(ops)
+    top = uncorrelate_top(ops[0]) if len(ops) == 1 else None
+    found = uncorrelated or top
+    decorrelate = (
+        found is not None
+        and from_obj.at is not None
+        and should_decorrelate(from_obj, found[0].parent.table)
+    )
+    if decorrelate and uncorrelated is not None:
+        values, from_obj = yield grouped_to_sql(ops, *uncorrelated, from_obj)
+    elif decorrelate and top is not None:
+        (op,) = ops
+        values, from_obj = yield top_to_sql(op, *top, from_obj)
+    else:
+        values, from_obj = yield lateral_to_sql(ops, from_obj)
+    existing = {**from_obj.existing}
+    for key, value in zip(keys, values):
+        if key is not None:
+            existing[key] = value
+    return values, from_obj.replace(existing=existing)
+
+
+def values_to_sql(ops: List[Op], from_obj):
+    """ Compile expressions of ``ops`` over the same relation."""
+    from_obj = yield rel_to_sql(ops[0].rel, from_obj=from_obj)
+    at = from_obj.at
+    exprs = []
+    for op in ops:
+        expr = None
+        if op.expr is not None:
+            expr, from_obj = yield expr_to_sql(
+                op.expr, from_obj=from_obj.replace(at=at)
+            )
+        exprs.append(expr)
+    return exprs, from_obj.replace(at=at)
+
+
+def value_label(idx):
+    return "value" if idx == 0 else f"value_{idx}"
+
 
-    if op.sig is None:
-        return expr, inner_from_obj
+def lateral_to_sql(ops: List[Op], from_obj):
+    """ Compile aggregates ``ops`` as a subquery correlated to the current row."""
+    exprs, inner_from_obj = yield values_to_sql(ops, from_obj)
 
     if inner_from_obj.limit is not None or inner_from_obj.order is not None:
+        assert len(ops) == 1, "unable to merge aggregates with LIMIT/ORDER"
+        (expr,) = exprs
         inner_from_obj = From.make(inner_from_obj.to_select(expr).alias())
-        value = sa.func.coalesce(
-            op.sig.compile([inner_from_obj.at.c.value]),
-            op.sig.unit,
-        )
+        if expr is not None:
+            exprs = [inner_from_obj.at.c.value]
+    values = [
+        sa.func.coalesce(op.sig.compile([expr]), op.sig.unit)
+        for op, expr in zip(ops, exprs)
+    ]
+    if len(values) == 1:
+        sel = inner_from_obj.to_select(values[0]).alias()
     else:
-        value = sa.func.coalesce(
-            op.sig.compile([expr]),
-            op.sig.unit,
+        sel = sa.select(
+            [v.label(value_label(idx)) for idx, v in enumerate(values)],
+            from_obj=inner_from_obj.current,
         )
-    sel = inner_from_obj.to_select(value).alias()
+        sel = inner_from_obj.filter(sel).alias()
     if from_obj.at is not None:
         from_obj, at = from_obj.join_lateral(sel)
     else:
         from_obj, at = from_obj.join_at(sel)
-    return at.c.value, from_obj
+    return [at.c[value_label(idx)] for idx in range(len(ops))], from_obj
+
+
+def grouped_to_sql(ops: List[Op], fk, rel: Rel, from_obj):
+    """
+    Compile aggregates ``ops`` over ``rel`` (which navigates from the current
+    row via ``fk``) as a subquery grouped by ``fk``.
+    """
+    base = From.make(fk.parent.table)
+    key = base.at.columns[fk.parent.name]
+    exprs, inner_from_obj = yield values_to_sql(
+        [op.replace(rel=rel) for op in ops], base
+    )
+    sel = sa.select(
+        [
+            key,
+            *(
+                op.sig.compile([expr]).label(value_label(idx))
+                for idx, (op, expr) in enumerate(zip(ops, exprs))
+            ),
+        ],
+        from_obj=inner_from_obj.current,
+    )
+    sel = inner_from_obj.filter(sel).group_by(key).alias()
+    at = from_obj.at
+    from_obj, joined = from_obj.join_at(
+        sel, (fk.column.name, fk.parent.name), outer=True
+    )
+    values = [
+        sa.func.coalesce(joined.c[value_label(idx)], op.sig.unit)
+        for idx, op in enumerate(ops)
+    ]
+    return values, from_obj.replace(at=at)
+
+
+def top_to_sql(op: Op, fk, rel: Rel, sort, take, from_obj):
+    """
+    Compile aggregate ``op`` over the first ``take`` rows of ``rel`` (which
+    navigates from the current row via ``fk``) sorted by ``sort`` as a
+    subquery grouped by ``fk``.
+
+    Rows are numbered within each group with ``row_number()`` (or just the
+    first row is picked with ``DISTINCT ON`` if ``take`` is 1) instead of
+    running ``LIMIT`` for each outer row.
+    """
+    base = From.make(fk.parent.table)
+    key = base.at.columns[fk.parent.name]
+    (expr,), inner_from_obj = yield values_to_sql([op.replace(rel=rel)], base)
+    at = inner_from_obj.at
+    order = []
+    for item in sort:
+        col, inner_from_obj = yield expr_to_sql(
+            item.expr, inner_from_obj.replace(at=at)
+        )
+        order.append(col.desc() if item.desc else col)
+    inner_from_obj = inner_from_obj.replace(at=at)
+
+    if take is None:
+        value = op.sig.compile([ordered(op, expr, order)])
+        sel = sa.select(
+            [key, value.label("value")],
+            from_obj=inner_from_obj.current,
+        )
+        sel = inner_from_obj.filter(sel).group_by(key)
+    else:
+        columns = [key]
+        if expr is not None:
+            columns.append(expr.label("value"))
+        if take.value == 1:
+            rows = sa.select(columns, from_obj=inner_from_obj.current)
+            rows = rows.distinct(key).order_by(key, *order)
+        else:
+            number = sa.func.row_number().over(
+                partition_by=key, order_by=order or None
+            )
+            rows = sa.select(
+                [*columns, number.label("number")],
+                from_obj=inner_from_obj.current,
+            )
+        rows = inner_from_obj.filter(rows).alias()
+        value = rows.c.value if expr is not None else None
+        if take.value != 1:
+            value = ordered(op, value, order and [rows.c.number])
+        sel = sa.select(
+            [rows.c[key.name], op.sig.compile([value]).label("value")],
+            from_obj=rows,
+        ).group_by(rows.c[key.name])
+        if take.value != 1:
+            limit, _ = yield expr_to_sql(take, inner_from_obj)
+            sel = sel.where(rows.c.number <= limit)
+
+    sel = sel.alias()
+    at = from_obj.at
+    from_obj, joined = from_obj.join_at(
+        sel, (fk.column.name, fk.parent.name), outer=True
+    )
+    value = sa.func.coalesce(joined.c.value, op.sig.unit)
+    return [value], from_obj.replace(at=at)
+
+
+def ordered(op: Op, expr, order):
+    """ Make aggregate ``op`` collect ``expr`` values in ``order``."""
+    if expr is None or not order or not isinstance(op.sig, JsonAggSig):
+        return expr
+    return aggregate_order_by(expr, *order)
+
+
+def prepare_aggregates(ops: List[Op], from_obj):
+    """
+    Compile aggregates nested in ``ops`` which would be computed for the
+    current row, merging those over the same relation into one subquery.
+    """
+    groups = {}
+    for op in nested_aggregates(ops):
+        key = aggregate_key(op, from_obj)
+        if key is None or key in from_obj.existing or not is_mergeable(op):
+            continue
+        if around_window(op, from_obj) is not None:
+            continue
+        group = groups.setdefault(fingerprints.get().of(op.rel), {})
+        group.setdefault(key, op)
+    at = from_obj.at
+    for group in groups.values():
+        if len(group) > 1:
+            _, from_obj = yield aggregates_to_sql(
+                list(group.values()), from_obj
+            )
+            from_obj = from_obj.replace(at=at)
+    return from_obj
+
+
+def nested_aggregates(ops: List[Op]):
+    """ Aggregates nested in ``ops`` which are compiled at the same row."""
+    found = []
+    queue = list(reversed(ops))
+    while queue:
+        node = queue.pop()
+        if isinstance(node, Op):
+            if node.sig is not None:
+                found.append(node)
+            elif isinstance(node.rel, RelParent) and node.expr is not None:
+                queue.append(node.expr)
+        elif isinstance(node, ExprOp):
+            queue.append(node.op)
+        elif isinstance(node, ExprApply):
+            args = [a for a in (node.expr, *node.args) if a is not None]
+            queue.extend(reversed(args))
+        elif isinstance(node, ExprRecord):
+            queue.extend(reversed([f.op for f in node.fields.values()]))
+    return found
+
+
+def is_mergeable(op: Op) -> bool:
+    rel = op.rel
+    while hasattr(rel, "rel"):
+        if isinstance(rel, (RelTake, RelSort, RelGroup)):
+            return False
+        rel = rel.rel
+    return True
+
+
+def uncorrelate(ops: List[Op]):
+    """
+    Make the relation of aggregates ``ops`` which navigates from the outer row
+    via a reverse foreign key into a relation over all rows of the referencing
+    table.
+
+    Returns the foreign key and the relation (``None`` if ``ops`` can't be
+    computed for all outer rows at once).
+    """
+    if any(refers_to_rows(op) for op in ops):
+        return None
+    return uncorrelate_rel(ops[0].rel)
+
+
+def uncorrelate_rel(rel: Rel):
+    path = []
+    while isinstance(rel, (RelJoin, RelRevJoin, RelFilter)):
+        if isinstance(rel, RelRevJoin) and isinstance(rel.rel, RelParent):
+            base = RelVoid()
+            for step in reversed(path):
+                base = step.replace(rel=base)
+            return rel.fk, base
+        path.append(rel)
+        rel = rel.rel
+    return None
+
+
+def uncorrelate_top(op: Op):
+    """
+    Like ``uncorrelate()`` but for aggregate ``op`` over a relation which is
+    sorted (and possibly limited to a constant number of rows).
+
+    Returns the foreign key, the relation, sort and the number of rows to
+    take (or ``None``).
+    """
+    if refers_to_rows(op):
+        return None
+    rel = op.rel
+    take = None
+    if isinstance(rel, RelTake):
+        take = rel.take
+        if (
+            isinstance(take, ExprOp)
+            and take.op.sig is None
+            and isinstance(take.op.rel, RelParent)
+        ):
+            take = take.op.expr
+        if not isinstance(take, ExprConst) or not isinstance(take.value, int):
+            return None
+        rel = rel.rel
+    sort = ()
+    if isinstance(rel, RelSort):
+        sort = rel.sort
+        rel = rel.rel
+    if not sort:
+        # Rows unsorted take() picks depend on the plan, keep compiling it
+        # to LIMIT for each outer row.
+        return None
+    uncorrelated = uncorrelate_rel(rel)
+    if uncorrelated is None:
+        return None
+    return (*uncorrelated, sort, take)
+
+
+def refers_to_rows(op: Op) -> bool:
+    """
+    Check if aggregate ``op`` (its relation, value or nested operations)
+    refers to the set of rows it is computed over (via ``around()`` or
+    ``_``) rather than just to the current row.
+
+    Such aggregates can't be computed for all outer rows at once as that
+    changes the set of rows.
+    """
+    seen = set()
+    queue = [op.rel, op.expr]
+    while queue:
+        value = queue.pop()
+        if isinstance(value, (list, tuple)):
+            queue.extend(value)
+            continue
+        if isinstance(value, dict):
+            queue.extend(value.values())
+            continue
+        if not isinstance(value, Struct) or id(value) in seen:
+            continue
+        seen.add(id(value))
+        if isinstance(value, (RelAroundParent, RelAggregateParent)):
+            return True
+        if isinstance(value, RelParent):
+            # the current row, rows it was planned from are not compiled
+            continue
+        if isinstance(value, Op) and value.sig is not None:
+            rel = value.rel
+            while isinstance(rel, (RelFilter, RelSort, RelTake)):
+                rel = rel.rel
+            if isinstance(rel, RelParent):
+                # an aggregate over the rows of the enclosing relation
+                return True
+        for f in dataclasses.fields(value):
+            if not isinstance(value, Op) or f.name not in ("scope", "syn"):
+                queue.append(getattr(value, f.name))
+    return False
+
+
+def should_decorrelate(from_obj, table: sa.Table) -> bool:
+    """
+    Check if aggregates over rows of ``table`` should be computed for all
+    outer rows at once.
+
+    That's the case if all outer rows are needed anyway, if there are many of
+    them (each would run its own subquery otherwise) or if ``table`` is small
+    enough to aggregate all of it.
+    """
+    decorrelate = decorrelation.get()
+    if decorrelate is not None:
+        return decorrelate
+    if not from_obj.where and from_obj.limit is None:
+        return True
+    rows = table.info.get("rows")
+    if rows is not None and rows <= LARGE:
+        return True
+    element = getattr(from_obj.at, "element", None)
+    if isinstance(element, sa.Table):
+        rows = element.info.get("rows")
+        return rows is not None and rows > LARGE
+    return False
+
+
+def is_correlated(rel: Rel) -> bool:
+    """
+    Check if ``rel`` starts with a subquery of its own (possibly correlated to
+    the current row) rather than with the enclosing FROM.
+    """
+    while not isinstance(rel, RelRevJoin) and hasattr(rel, "rel"):
+        rel = rel.rel
+    return isinstance(rel, (RelRevJoin, RelTable))
 
 
 @singledispatch
@@ -181,7 +874,7 @@ def RelJoin_to_sql(rel: RelJoin, from_obj):
             )
         )
     else:
-        from_obj = rel_to_sql(rel.rel, from_obj=from_obj)
+        from_obj = yield rel_to_sql(rel.rel, from_obj=from_obj)
         from_obj, _ = from_obj.join_at(
             rel.fk.column.table,
             (rel.fk.parent.name, rel.fk.column.name),
@@ -194,18 +887,18 @@ def RelJoin_to_sql(rel: RelJoin, from_obj):
 @rel_to_sql.register
 def RelRevJoin_to_sql(rel: RelRevJoin, from_obj):
     if isinstance(rel.rel, RelParent):
-        table = rel.fk.parent.table.alias()
-        return From.make(
-            table.select()
-            .correlate(from_obj.at)
-            .where(
-                table.columns[rel.fk.parent.name]
-                == from_obj.at.columns[rel.fk.column.name]
-            )
-            .alias()
+        # Correlate on the foreign key column directly (rather than selecting
+        # all columns in a correlated subquery first) so the foreign key index
+        # can be used.
+        inner_from_obj = From.make(rel.fk.parent.table).replace(
+            correlate=from_obj.at
+        )
+        return inner_from_obj.add_where(
+            inner_from_obj.at.columns[rel.fk.parent.name]
+            == from_obj.at.columns[rel.fk.column.name]
         )
     else:
-        from_obj = rel_to_sql(rel.rel, from_obj=from_obj)
+        from_obj = yield rel_to_sql(rel.rel, from_obj=from_obj)
         from_obj, _ = from_obj.join_at(
             rel.fk.parent.table,
             (rel.fk.column.name, rel.fk.parent.name),
@@ -217,13 +910,13 @@ def RelRevJoin_to_sql(rel: RelRevJoin, from_obj):
 
 @rel_to_sql.register
 def RelTake_to_sql(rel: RelTake, from_obj):
-    from_obj = rel_to_sql(rel.rel, from_obj)
+    from_obj = yield rel_to_sql(rel.rel, from_obj)
     # If we have already LIMIT set we need to produce wrap this FROM as a
     # subselect with another LIMIT.
     if from_obj.limit is not None:
         from_obj = from_obj.make(from_obj.to_select(None).alias())
     at = from_obj.at
-    take, from_obj = expr_to_sql(rel.take, from_obj)
+    take, from_obj = yield expr_to_sql(rel.take, from_obj)
     from_obj = from_obj.replace(at=at)
     from_obj = from_obj.add_limit(take)
     return from_obj
@@ -231,7 +924,7 @@ def RelTake_to_sql(rel: RelTake, from_obj):
 
 @rel_to_sql.register
 def RelSort_to_sql(rel: RelSort, from_obj):
-    from_obj = rel_to_sql(rel.rel, from_obj)
+    from_obj = yield rel_to_sql(rel.rel, from_obj)
     # If we have already LIMIT set we need to produce wrap this FROM as a
     # subselect with another LIMIT.
     if from_obj.limit is not None or from_obj.order is not None:
@@ -239,7 +932,7 @@ def RelSort_to_sql(rel: RelSort, from_obj):
     at = from_obj.at
     order_by = []
     for sort in rel.sort:
-        col, from_obj = expr_to_sql(sort.expr, from_obj.replace(at=at))
+        col, from_obj = yield expr_to_sql(sort.expr, from_obj.replace(at=at))
         if sort.desc:
             col = col.desc()
         order_by.append(col)
@@ -250,13 +943,13 @@ def RelSort_to_sql(rel: RelSort, from_obj):
 
 @rel_to_sql.register
 def RelFilter_to_sql(rel: RelFilter, from_obj):
-    from_obj = rel_to_sql(rel.rel, from_obj)
+    from_obj = yield rel_to_sql(rel.rel, from_obj)
     # If we have already LIMIT set we need to produce wrap this FROM as a
     # subselect with WHERE.
     if from_obj.limit is not None:
         from_obj = from_obj.make(from_obj.to_select(None).alias())
     at = from_obj.at
-    expr, from_obj = expr_to_sql(rel.expr, from_obj)
+    expr, from_obj = yield expr_to_sql(rel.expr, from_obj)
     from_obj = from_obj.replace(at=at)
     from_obj = from_obj.add_where(expr)
     return from_obj
@@ -274,10 +967,10 @@ def RelAggregateParent_to_sql(rel: RelAggregateParent, from_obj):
 
 @rel_to_sql.register
 def RelGroup_to_sql(rel: RelGroup, from_obj):
-    from_obj = rel_to_sql(rel.rel, from_obj=from_obj)
-
-    # TODO(andreypopp): might need to convert this to CTE for complex
-    # expressions
+    from_obj = yield rel_to_sql(rel.rel, from_obj=from_obj)
+    # Rows need to be limited before they are grouped.
+    if from_obj.limit is not None:
+        from_obj = from_obj.make(from_obj.to_select(None).alias())
     initial_from_obj = from_obj
 
     def build_kernel():
@@ -285,22 +978,65 @@ def RelGroup_to_sql(rel: RelGroup, from_obj):
         at = from_obj.at
         columns = []
         for field in rel.fields.values():
-            expr, from_obj = op_to_sql(
+            expr, from_obj = yield op_to_sql(
                 field.op,
                 from_obj=from_obj.replace(at=at),
             )
+            if isinstance(expr, Tuple):
+                # Composite identities are grouped as arrays so keys are
+                # returned in the same shape as identities elsewhere.
+                expr = sa.func.jsonb_build_array(*expr.clauses)
             columns.append(expr.label(field.name))
         columns = from_obj.group_by_columns + tuple(columns)
         return columns, from_obj.replace(at=at, group_by_columns=columns)
 
-    columns, from_obj = build_kernel()
+    # Aggregates of the rows being grouped are computed along with the
+    # grouping itself, others need a separate pass over the kernel (the rows
+    # with their group keys), which is then shared as CTE.
+    folded = {}
+    for field in rel.compute:
+        filters = kernel_filters(field.op)
+        if filters is not None and rel.fields:
+            folded[field.name] = filters
+
+    columns, from_obj = yield build_kernel()
+    if len(folded) < len(rel.compute) and can_share_kernel(rel, from_obj):
+        kernel = kernel_cte(from_obj)
+        columns = tuple(kernel.c[c.name] for c in columns)
+        shared = From.make(kernel).replace(group_by_columns=columns)
+
+        def build_kernel():
+            return columns, shared
+            yield  # pragma: no cover
+
+        from_obj = shared
+
+    at = from_obj.at
+    aggregates = []
+    for field in rel.compute:
+        if field.name not in folded:
+            continue
+        value, from_obj = yield aggregate_to_kernel(
+            field.op, folded[field.name], from_obj.replace(at=at)
+        )
+        aggregates.append(value.label(field.name))
+    having = []
+    for expr in rel.having:
+        expr, from_obj = yield expr_to_sql(
+            expr, from_obj=from_obj.replace(at=at)
+        )
+        having.append(expr)
+    from_obj = from_obj.replace(at=at)
     if columns:
         sel = sa.select(
-            [*from_obj.group_by_columns, *columns], from_obj=from_obj.current
+            [*from_obj.group_by_columns, *columns, *aggregates],
+            from_obj=from_obj.current,
         )
-        if from_obj.where is not None:
-            sel = sel.where(from_obj.where)
-        sel = sel.group_by(*from_obj.group_by_columns).alias()
+        sel = from_obj.filter(sel)
+        sel = sel.group_by(*from_obj.group_by_columns)
+        if having:
+            sel = sel.having(sa.and_(*having))
+        sel = sel.alias()
         from_obj = From.make(sel)
     else:
         sel = sa.select(
@@ -312,42 +1048,147 @@ def RelGroup_to_sql(rel: RelGroup, from_obj):
     if not rel.compute:
         return from_obj
 
-    result_columns = [from_obj.current.columns[c.name] for c in tuple(columns)]
+    at = from_obj.at
+    result_columns = [at.columns[c.name] for c in tuple(columns)]
     for field in rel.compute:
+        if field.name in folded:
+            result_columns.append(at.columns[field.name])
+            continue
         op = field.op
         assert op.sig is not None
-        columns, kernel = build_kernel()
+        columns, kernel = yield build_kernel()
 
         value = None
-        inner_from_obj = rel_to_sql(op.rel, from_obj=kernel)
+        inner_from_obj = yield rel_to_sql(op.rel, from_obj=kernel)
         if op.expr is not None:
-            value, inner_from_obj = expr_to_sql(
+            value, inner_from_obj = yield expr_to_sql(
                 op.expr, from_obj=inner_from_obj
             )
 
-        value = op.sig.compile([value])
         if kernel.current in inner_from_obj.current._from_objects:
             cols = columns
         else:
             cols = [inner_from_obj.current.columns[c.name] for c in columns]
+        order = inner_from_obj.order or ()
+        if inner_from_obj.limit is not None:
+            # Number rows within each group to take the first ones.
+            number = sa.func.row_number().over(
+                partition_by=cols, order_by=order or None
+            )
+            rows = [*cols, number.label("number")]
+            if value is not None:
+                rows.append(value.label("value"))
+            rows = sa.select(rows, from_obj=inner_from_obj.current)
+            rows = inner_from_obj.filter(rows).alias()
+            cols = [rows.c[c.name] for c in columns]
+            value = rows.c.value if value is not None else None
+            order = [rows.c.number]
+            inner_from_obj = From.make(rows).add_where(
+                rows.c.number <= inner_from_obj.limit
+            )
+        value = op.sig.compile([ordered(op, value, order)])
         inner_sel = sa.select(
             [*cols, value.label("value")],
             from_obj=inner_from_obj.current,
         ).group_by(*cols)
-        if inner_from_obj.where is not None:
-            inner_sel = inner_sel.where(inner_from_obj.where)
+        inner_sel = inner_from_obj.filter(inner_sel)
         inner_sel = inner_sel.alias()
-        from_obj, inner_at = from_obj.join_at(
+        from_obj, inner_at = from_obj.replace(at=at).join_at(
             inner_sel, *((c.name, c.name) for c in columns), outer=True
         )
         result_columns.append(
             sa.func.coalesce(inner_at.c.value, op.sig.unit).label(field.name)
         )
 
-    from_obj = From.make(
-        sa.select(result_columns, from_obj=from_obj.current).alias()
-    )
-    return from_obj
+    sel = sa.select(result_columns, from_obj=from_obj.current)
+    return From.make(sel.alias())
+
+
+def kernel_filters(op: Op):
+    """
+    Filters of the rows being grouped ``op`` aggregates, ``None`` if ``op``
+    aggregates anything other than (filtered) values of the rows.
+    """
+    filters, rel = split_filters(op.rel)
+    if not isinstance(rel, RelAggregateParent):
+        return None
+    if not all(is_row_expr(expr) for expr in (op.expr, *filters)):
+        return None
+    return filters
+
+
+def split_filters(rel: Rel):
+    """ Split ``rel`` into filters on top of it and the relation below."""
+    filters = []
+    while isinstance(rel, RelFilter):
+        filters.append(rel.expr)
+        rel = rel.rel
+    return filters, rel
+
+
+def is_row_expr(expr: Expr) -> bool:
+    """ Check if ``expr`` is computed from the current row alone."""
+    queue = [expr]
+    while queue:
+        expr = queue.pop()
+        if isinstance(expr, ExprApply):
+            queue.extend(a for a in (expr.expr, *expr.args) if a is not None)
+        elif isinstance(expr, ExprOp):
+            if expr.op.sig is not None or not isinstance(
+                expr.op.rel, RelParent
+            ):
+                return False
+            queue.append(expr.op.expr)
+        elif not isinstance(expr, (ExprColumn, ExprConst, type(None))):
+            return False
+    return True
+
+
+def aggregate_to_kernel(op: Op, filters: List[Expr], from_obj, window=None):
+    """
+    Compile aggregate ``op`` of the current rows filtered by ``filters``.
+
+    If ``window`` is not ``None`` the aggregate is computed as a window
+    function partitioned by ``window`` columns.
+    """
+    value = None
+    if op.expr is not None:
+        value, from_obj = yield expr_to_sql(op.expr, from_obj)
+    value = op.sig.compile([value])
+    conditions = []
+    for expr in reversed(filters):
+        condition, from_obj = yield expr_to_sql(expr, from_obj)
+        conditions.append(condition)
+    if window is not None:
+        # rows without a link are not around each other
+        conditions.extend(c.isnot(None) for c in window if c.nullable)
+    if conditions:
+        value = value.filter(sa.and_(*conditions))
+    if window is not None:
+        value = value.over(partition_by=list(window) or None)
+    return sa.func.coalesce(value, op.sig.unit), from_obj
+
+
+def can_share_kernel(rel: RelGroup, from_obj) -> bool:
+    """
+    Check if the kernel of ``rel`` can be compiled as CTE: it doesn't depend
+    on the enclosing query (so the CTE can be defined at the top) and its
+    group keys don't clash with the column names.
+    """
+    if not rel.fields or from_obj.correlate is not None:
+        return False
+    if len(from_obj.group_by_columns) != len(rel.fields):
+        return False
+    if not isinstance(base_rel(rel.rel), RelTable):
+        return False
+    names = {c.name for c in from_obj.at_columns()}
+    return not names & set(rel.fields)
+
+
+def kernel_cte(from_obj):
+    """ Rows being grouped along with their group keys as CTE."""
+    sel = from_obj.to_select(None)
+    return sel.cte(_anonymous_label("%%(%d kernel)s" % id(sel)))
 
 
 @singledispatch
@@ -366,11 +1207,19 @@ def ExprOp_to_sql(expr: ExprOp, from_obj):
 def ExprRecord_to_sql(op: ExprRecord, from_obj):
     args = []
     at = from_obj.at
+    from_obj = yield prepare_aggregates(
+        [field.op for field in op.fields.values()], from_obj
+    )
     for field in op.fields.values():
         args.append(sa.literal(field.name))
-        expr, from_obj = op_to_sql(field.op, from_obj=from_obj.replace(at=at))
+        expr, from_obj = yield op_to_sql(
+            field.op, from_obj=from_obj.replace(at=at)
+        )
         args.append(expr)
-    return sa.func.jsonb_build_object(*args), from_obj
+    build = (
+        sa.func.jsonb_build_object if op.jsonb else sa.func.json_build_object
+    )
+    return build(*args), from_obj
 
 
 @expr_to_sql.register
@@ -380,10 +1229,14 @@ def ExprColumn_to_sql(expr: ExprColumn, from_obj):
 
 @expr_to_sql.register
 def ExprIdentity_to_sql(op: ExprIdentity, from_obj):
-    pk = []
-    for col in op.table.primary_key.columns:
-        pk.append(from_obj.at.columns[col.name])
-    return sa.cast(sa.func.row(*pk), sa.String()), from_obj
+    columns = op.table.primary_key.columns or op.table.columns
+    pk = [from_obj.at.columns[col.name] for col in columns]
+    if len(pk) == 1:
+        return pk[0], from_obj
+    # Composite keys are compared as rows but returned as arrays.
+    if op.json:
+        return sa.func.json_build_array(*pk), from_obj
+    return sa.tuple_(*pk), from_obj
 
 
 @expr_to_sql.register
@@ -391,16 +1244,22 @@ def ExprConst_to_sql(op: ExprConst, from_obj):
     return op.embed(op.value), from_obj
 
 
+@expr_to_sql.register
+def ExprExists_to_sql(expr: ExprExists, from_obj):
+    inner_from_obj = yield rel_to_sql(expr.rel, from_obj=from_obj)
+    return sa.exists(inner_from_obj.to_select(sa.literal(1))), from_obj
+
+
 @expr_to_sql.register
 def ExprApply_to_sql(op: ExprApply, from_obj):
     if op.expr is not None:
-        parent, from_obj = expr_to_sql(op.expr, from_obj)
+        parent, from_obj = yield expr_to_sql(op.expr, from_obj)
     else:
         parent = None
     at = from_obj.at
     args = []
     for arg in op.args:
-        expr, from_obj = expr_to_sql(arg, from_obj.replace(at=at))
+        expr, from_obj = yield expr_to_sql(arg, from_obj.replace(at=at))
         args.append(expr)
     from_obj = from_obj.replace(at=at)
     expr = op.compile(parent, args)
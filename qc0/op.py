@@ -116,6 +116,7 @@ class RelSort(Rel):
 class RelGroup(RelWithCompute):
     rel: Rel
     fields: Dict[str, Field]
+    having: List[Expr] = ()
 
 
 class Expr(Struct):
@@ -128,6 +129,7 @@ class ExprOp(Expr):
 
 class ExprRecord(Expr):
     fields: Dict[str, Field]
+    jsonb: bool = True
 
 
 class ExprColumn(Expr):
@@ -136,6 +138,11 @@ class ExprColumn(Expr):
 
 class ExprIdentity(Expr):
     table: Table
+    json: bool = False
+
+
+class ExprExists(Expr):
+    rel: Rel
 
 
 class ExprConst(Expr):
@@ -147,6 +154,7 @@ class ExprApply(Expr):
     expr: Optional[Expr]
     args: List[Expr]
     compile: Callable[[Expr, List[Expr]], Any]
+    sig: Any = None
 
 
 class Field(Struct):
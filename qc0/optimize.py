@@ -0,0 +1,770 @@
+"""
+
+    qc0.optimize
+    ============
+
+    Rewrite operations into equivalent ones which compile to cheaper SQL.
+
+"""
+
+from __future__ import annotations
+
+import datetime
+import collections.abc
+from functools import singledispatch
+from typing import Any, Optional
+
+import sqlalchemy as sa
+
+from .base import Struct, trampoline, type_hints, cached
+from .scope import DatePart
+from .sig import (
+    JsonAggSig,
+    AndSig,
+    OrSig,
+    NotSig,
+    ExistsSig,
+    CountSig,
+    EqSig,
+    NeSig,
+    LtSig,
+    GtSig,
+    LeSig,
+    GeSig,
+    SubstringSig,
+    LikeSig,
+)
+from .op import (
+    Op,
+    Rel,
+    RelJoin,
+    RelParent,
+    RelAggregateParent,
+    RelAroundParent,
+    RelFilter,
+    RelSort,
+    RelGroup,
+    Expr,
+    ExprOp,
+    ExprColumn,
+    ExprRecord,
+    ExprIdentity,
+    ExprConst,
+    ExprApply,
+    ExprExists,
+    Field,
+    Sort,
+)
+
+# Structs rewrite descends into, everything else (scopes, syntax, signatures)
+# is kept as is.
+NODES = (Op, Rel, Expr, Field, Sort)
+
+
+@cached
+def node_fields(cls):
+    """ Names of ``cls`` fields which can hold nodes."""
+    return tuple(k for k, t in type_hints(cls).items() if holds_nodes(t))
+
+
+def holds_nodes(t):
+    if isinstance(t, type):
+        return issubclass(t, NODES)
+    if getattr(t, "__origin__", None) is collections.abc.Callable:
+        return False
+    return any(holds_nodes(a) for a in getattr(t, "__args__", ()))
+
+
+def optimize(op: Op) -> Op:
+    """ Optimize operations."""
+    op = trampoline(rewrite(op, Context()))
+    return trampoline(output_json(op))
+
+
+class Context:
+    """
+    State of an optimization pass.
+
+    Maps are keyed by node ids and hold nodes themselves along with values,
+    so the ids aren't reused while the pass runs.
+    """
+
+    def __init__(self):
+        # Rewritten nodes.
+        self.seen = {}
+        # Rels below filters and sorts, see base_rel().
+        self.bases = {}
+
+
+def rewrite(node, ctx: Context):
+    """
+    Rewrite ``node`` bottom up applying rules from ``rewrite_node``.
+
+    Shared nodes are rewritten once.
+    """
+    if id(node) in ctx.seen:
+        return ctx.seen[id(node)][1]
+    changes = {}
+    # Ops referenced by RelParent are only needed for planning.
+    if not isinstance(node, RelParent):
+        for name in node_fields(type(node)):
+            value = getattr(node, name)
+            next_value = yield rewrite_value(value, ctx)
+            if next_value is not value:
+                changes[name] = next_value
+    next_node = node.replace(**changes) if changes else node
+    next_node = yield rewrite_node(next_node, ctx)
+    ctx.seen[id(node)] = node, next_node
+    return next_node
+
+
+def rewrite_value(value, ctx: Context):
+    if isinstance(value, NODES):
+        return (yield rewrite(value, ctx))
+    if isinstance(value, (list, tuple)):
+        items = []
+        for item in value:
+            items.append((yield rewrite_value(item, ctx)))
+        if all(a is b for a, b in zip(items, value)):
+            return value
+        return type(value)(items)
+    if isinstance(value, dict):
+        items = {}
+        for k, item in value.items():
+            items[k] = yield rewrite_value(item, ctx)
+        if all(items[k] is item for k, item in value.items()):
+            return value
+        return items
+    return value
+
+
+@singledispatch
+def rewrite_node(node, ctx: Context):
+    return node
+
+
+@rewrite_node.register
+def RelFilter_rewrite_node(node: RelFilter, ctx: Context):
+    expr = yield exists_expr(node.expr)
+    expr = sargable_expr(expr)
+    if expr is not node.expr:
+        node = node.replace(expr=expr)
+    if not isinstance(base_rel(node.rel, ctx), RelGroup):
+        return node
+    rel = node.rel
+    for expr in conjuncts(node.expr):
+        rel = yield filter_rel(rel, expr)
+    return rel
+
+
+@rewrite_node.register
+def Op_rewrite_node(node: Op, ctx: Context):
+    if not counts_rows(node):
+        return node
+    rel = node.rel
+    # Joins through NOT NULL foreign keys match exactly one row and sorting
+    # doesn't change the number of rows either.
+    while (
+        isinstance(rel, RelJoin)
+        and not rel.fk.parent.nullable
+        and not isinstance(rel.rel, RelAroundParent)
+        or isinstance(rel, RelSort)
+    ):
+        rel = rel.rel
+    return node if rel is node.rel else node.replace(rel=rel)
+
+
+def counts_rows(op: Op) -> bool:
+    """ Check if ``op`` depends only on the number of rows of its rel."""
+    if isinstance(op.sig, ExistsSig):
+        return True
+    return isinstance(op.sig, CountSig) and op.expr is None
+
+
+def base_rel(rel: Rel, ctx: Context) -> Rel:
+    """ Rel below filters and sorts on top of ``rel``."""
+    path = []
+    while isinstance(rel, (RelFilter, RelSort)) and id(rel) not in ctx.bases:
+        path.append(rel)
+        rel = rel.rel
+    if id(rel) in ctx.bases:
+        rel = ctx.bases[id(rel)][1]
+    for above in path:
+        ctx.bases[id(above)] = above, rel
+    return rel
+
+
+def conjuncts(expr: Expr):
+    """ Split ``expr`` into a list of expressions joined with AND."""
+    result = []
+    queue = [expr]
+    while queue:
+        expr = queue.pop()
+        if (
+            isinstance(expr, ExprOp)
+            and isinstance(expr.op.rel, RelParent)
+            and expr.op.sig is None
+            and isinstance(expr.op.expr, ExprApply)
+            and isinstance(expr.op.expr.sig, AndSig)
+        ):
+            a, b = expr.op.expr.args
+            queue.extend((b, a))
+        else:
+            result.append(expr)
+    return result
+
+
+#
+# Predicate pushdown
+#
+
+
+def filter_rel(rel: Rel, expr: Expr):
+    """ Filter ``rel`` by ``expr`` pushing the filter as far down as possible."""
+    pushed = yield push_filter(rel, expr)
+    if pushed is not None:
+        return pushed
+    return RelFilter(rel=rel, expr=sargable_expr(expr))
+
+
+@singledispatch
+def push_filter(rel: Rel, expr: Expr) -> Optional[Rel]:
+    """
+    Push filter by ``expr`` below ``rel``.
+
+    Returns ``None`` if the filter can't be pushed (and thus should stay on
+    top of ``rel``).
+    """
+    return None
+
+
+@push_filter.register
+def RelFilter_push_filter(rel: RelFilter, expr: Expr):
+    # Filters commute, but let's not reorder them unless the filter goes
+    # further down.
+    pushed = yield push_filter(rel.rel, expr)
+    return None if pushed is None else rel.replace(rel=pushed)
+
+
+@push_filter.register
+def RelSort_push_filter(rel: RelSort, expr: Expr):
+    pushed = yield push_filter(rel.rel, expr)
+    return None if pushed is None else rel.replace(rel=pushed)
+
+
+@push_filter.register
+def RelGroup_push_filter(rel: RelGroup, expr: Expr):
+    # A predicate which references only group keys can filter the rows being
+    # grouped instead, so it ends up inside the kernel.
+    next_expr = yield key_expr(expr, rel)
+    if next_expr is not None:
+        return rel.replace(rel=(yield filter_rel(rel.rel, next_expr)))
+    # A predicate which references aggregates of the rows being grouped as
+    # well becomes HAVING.
+    if not rel.fields:
+        return None
+    used = set()
+    next_expr = yield key_expr(expr, rel, used)
+    if next_expr is None:
+        return None
+    # Aggregates which are now computed by HAVING are not referenced
+    # elsewhere.
+    return rel.replace(
+        having=(*rel.having, next_expr),
+        compute=[f for f in rel.compute if f.name not in used],
+    )
+
+
+@singledispatch
+def key_expr(expr: Expr, rel: RelGroup, used=None) -> Optional[Expr]:
+    """
+    Rewrite ``expr`` over the rows of ``rel`` group into an expression over
+    the rows being grouped.
+
+    If ``used`` set is passed then aggregates computed over the rows being
+    grouped are allowed too, their names are added to ``used``.
+
+    Returns ``None`` if ``expr`` references anything but group keys (or
+    aggregates).
+    """
+    return None
+
+
+@key_expr.register
+def ExprOp_key_expr(expr: ExprOp, rel: RelGroup, used=None):
+    op = expr.op
+    if op.sig is not None or not isinstance(op.rel, RelParent):
+        return None
+    if op.expr is None:
+        return None
+    next_expr = yield key_expr(op.expr, rel, used)
+    if next_expr is None:
+        return None
+    return ExprOp(op.replace(expr=next_expr))
+
+
+@key_expr.register
+def ExprColumn_key_expr(expr: ExprColumn, rel: RelGroup, used=None):
+    field = rel.fields.get(expr.column.name)
+    if field is not None and field.op.sig is None:
+        return ExprOp(field.op)
+    if used is None:
+        return None
+    for field in rel.compute:
+        if field.name == expr.column.name and is_kernel_aggregate(field.op):
+            used.add(field.name)
+            return aggregate_expr(field.op)
+    return None
+
+
+def is_kernel_aggregate(op: Op) -> bool:
+    """ Check if ``op`` aggregates values of the rows being grouped."""
+    if not isinstance(op.rel, RelAggregateParent):
+        return False
+    queue = [op.expr]
+    while queue:
+        expr = queue.pop()
+        if isinstance(expr, ExprApply):
+            queue.extend(a for a in (expr.expr, *expr.args) if a is not None)
+        elif not isinstance(expr, (ExprColumn, ExprConst, type(None))):
+            return False
+    return True
+
+
+def aggregate_expr(op: Op) -> Expr:
+    sig = op.sig
+    return ExprApply(
+        expr=op.expr,
+        args=(),
+        compile=lambda value, _args: sa.func.coalesce(
+            sig.compile([value]), sig.unit
+        ),
+        sig=sig,
+    )
+
+
+@key_expr.register
+def ExprConst_key_expr(expr: ExprConst, rel: RelGroup, used=None):
+    return expr
+
+
+@key_expr.register
+def ExprApply_key_expr(expr: ExprApply, rel: RelGroup, used=None):
+    parent = None
+    if expr.expr is not None:
+        parent = yield key_expr(expr.expr, rel, used)
+        if parent is None:
+            return None
+    args = []
+    for arg in expr.args:
+        arg = yield key_expr(arg, rel, used)
+        if arg is None:
+            return None
+        args.append(arg)
+    return expr.replace(expr=parent, args=type(expr.args)(args))
+
+
+#
+# Existence tests
+#
+
+# Comparisons of count() with a constant which test for existence (True) or
+# non existence (False) of rows.
+COUNT_TESTS = {
+    (GtSig, 0): True,
+    (NeSig, 0): True,
+    (GeSig, 1): True,
+    (EqSig, 0): False,
+    (LeSig, 0): False,
+    (LtSig, 1): False,
+}
+
+# Comparison with operands swapped.
+FLIPPED = {
+    GtSig: LtSig,
+    LtSig: GtSig,
+    GeSig: LeSig,
+    LeSig: GeSig,
+    EqSig: EqSig,
+    NeSig: NeSig,
+}
+
+
+def exists_expr(expr: Expr):
+    """
+    Rewrite existence tests in filter predicate ``expr`` (``exists()`` and
+    comparisons of ``count()`` with zero) into ``EXISTS`` subqueries.
+
+    Unlike aggregates those stop at the first matching row.
+    """
+    if not isinstance(expr, ExprOp):
+        return expr
+    op = expr.op
+    if isinstance(op.sig, ExistsSig):
+        return ExprExists(rel=op.rel)
+    if (
+        op.sig is not None
+        or not isinstance(op.rel, RelParent)
+        or not isinstance(op.expr, ExprApply)
+    ):
+        return expr
+    apply = op.expr
+    if isinstance(apply.sig, (AndSig, OrSig)):
+        args = []
+        for arg in apply.args:
+            args.append((yield exists_expr(arg)))
+        if all(a is b for a, b in zip(args, apply.args)):
+            return expr
+        next_expr = apply.replace(args=type(apply.args)(args))
+    elif isinstance(apply.sig, NotSig) and apply.expr is not None:
+        arg = yield exists_expr(apply.expr)
+        if arg is apply.expr:
+            return expr
+        next_expr = apply.replace(expr=arg)
+    else:
+        next_expr = count_test(apply)
+        if next_expr is None:
+            return expr
+    return ExprOp(op.replace(expr=next_expr))
+
+
+def count_test(expr: ExprApply) -> Optional[Expr]:
+    """ Rewrite comparison of ``count()`` with a constant into ``EXISTS``."""
+    if type(expr.sig) not in FLIPPED:
+        return None
+    a, b = expr.args
+    sig = type(expr.sig)
+    if not is_count(a):
+        a, b, sig = b, a, FLIPPED[sig]
+    if not is_count(a):
+        return None
+    value = const_value(b)
+    if type(value) is not int:
+        return None
+    exists = COUNT_TESTS.get((sig, value))
+    if exists is None:
+        return None
+    test = ExprExists(rel=a.op.rel)
+    if exists:
+        return test
+    return ExprApply(expr=test, args=(), compile=NotSig.compile, sig=NotSig())
+
+
+def is_count(expr: Expr) -> bool:
+    # count() of values skips NULLs, only count() of rows is a test for rows.
+    return (
+        isinstance(expr, ExprOp)
+        and isinstance(expr.op.sig, CountSig)
+        and expr.op.expr is None
+    )
+
+
+def const_value(expr: Expr):
+    if (
+        isinstance(expr, ExprOp)
+        and expr.op.sig is None
+        and isinstance(expr.op.rel, RelParent)
+    ):
+        expr = expr.op.expr
+    return expr.value if isinstance(expr, ExprConst) else None
+
+
+#
+# Index friendly predicates
+#
+
+
+def sargable_expr(expr: Expr) -> Expr:
+    """
+    Rewrite filter predicate ``expr`` into an equivalent one which can use
+    indexes.
+    """
+    return prefix_expr(date_range_expr(expr))
+
+
+class DateTest(Struct):
+    """
+    Comparison of ``part`` of ``date`` with ``value``.
+
+    Tests of the same date have equal ``key``.
+    """
+
+    date: Expr
+    key: Any
+    part: str
+    sig: Any
+    value: int
+
+
+def date_range_expr(expr: Expr) -> Expr:
+    """
+    Rewrite comparisons of ``year`` of a date with a constant in filter
+    predicate ``expr`` into comparisons of the date itself, so that indexes on
+    the date can be used.
+
+    Tests for ``year`` along with ``month`` (and ``day``) are combined into a
+    single range.
+    """
+    tests = conjuncts(expr)
+    found = [date_test(test) for test in tests]
+    ranges = {}
+    used = set()
+    for idx, test in enumerate(found):
+        if test is None or test.part != "year":
+            continue
+        parts = {}
+        if test.sig is EqSig:
+            # equalities on month and day of the same date narrow the range
+            for other, t in enumerate(found):
+                if (
+                    t is not None
+                    and t.part in ("month", "day")
+                    and t.part not in parts
+                    and t.sig is EqSig
+                    and t.key == test.key
+                    and other not in used
+                ):
+                    parts[t.part] = other
+        if "month" not in parts:
+            parts.pop("day", None)
+        values = [
+            found[parts[p]].value for p in ("month", "day") if p in parts
+        ]
+        bounds = date_range(test.value, *values)
+        if bounds is None:
+            continue
+        ranges[idx] = range_test(tests[idx], test.date, test.sig, *bounds)
+        used.update(parts.values())
+    if not ranges:
+        return expr
+    return and_expr(
+        [
+            ranges.get(idx, test)
+            for idx, test in enumerate(tests)
+            if idx not in used
+        ]
+    )
+
+
+def date_test(expr: Expr) -> Optional[DateTest]:
+    """ Match comparison of a part of a date with an integer constant."""
+    expr = scalar_expr(expr)
+    if not isinstance(expr, ExprApply) or type(expr.sig) not in FLIPPED:
+        return None
+    a, b = expr.args
+    sig = type(expr.sig)
+    if date_part(a) is None:
+        a, b, sig = b, a, FLIPPED[sig]
+    found = date_part(a)
+    value = const_value(b)
+    if found is None or type(value) is not int:
+        return None
+    date, key, part = found
+    return DateTest(date=date, key=key, part=part, sig=sig, value=value)
+
+
+def date_part(expr: Expr):
+    """ Match part of a date as ``(date, key, part)``."""
+    apply, ops = inner_expr(expr)
+    if not isinstance(apply, ExprApply) or not isinstance(
+        apply.compile, DatePart
+    ):
+        return None
+    # ops the date is computed by differ in syntax they were planned from
+    key = (tuple(op.rel for op in ops), apply.expr)
+    return wrap_expr(apply.expr, ops), key, apply.compile.part
+
+
+def inner_expr(expr: Expr):
+    """ Unwrap ``expr`` from ops it is computed by."""
+    ops = []
+    while isinstance(expr, ExprOp) and expr.op.sig is None:
+        ops.append(expr.op)
+        expr = expr.op.expr
+    return expr, ops
+
+
+def wrap_expr(expr: Expr, ops) -> Expr:
+    """ Compute ``expr`` by ``ops`` (as returned by ``inner_expr()``)."""
+    for op in reversed(ops):
+        expr = ExprOp(op.replace(expr=expr))
+    return expr
+
+
+def scalar_expr(expr: Expr) -> Expr:
+    """ Unwrap ``expr`` which is computed at the current row."""
+    while (
+        isinstance(expr, ExprOp)
+        and expr.op.sig is None
+        and isinstance(expr.op.rel, RelParent)
+    ):
+        expr = expr.op.expr
+    return expr
+
+
+def date_range(year, month=None, day=None):
+    """ Half open range of dates for ``year`` (and ``month``, ``day``)."""
+    try:
+        if month is None:
+            return datetime.date(year, 1, 1), datetime.date(year + 1, 1, 1)
+        start = datetime.date(year, month, day or 1)
+        if day is not None:
+            return start, start + datetime.timedelta(days=1)
+        if month == 12:
+            return start, datetime.date(year + 1, 1, 1)
+        return start, datetime.date(year, month + 1, 1)
+    except (ValueError, OverflowError):
+        return None
+
+
+def range_test(test: Expr, date: Expr, sig, start, end) -> Expr:
+    """
+    Compare ``date`` with the range ``[start, end)`` as ``test`` compares the
+    date part.
+    """
+    if sig is EqSig:
+        return and_expr(
+            [
+                compare(test, GeSig, date, start),
+                compare(test, LtSig, date, end),
+            ]
+        )
+    if sig is NeSig:
+        return or_expr(
+            test,
+            compare(test, LtSig, date, start),
+            compare(test, GeSig, date, end),
+        )
+    if sig is LtSig:
+        return compare(test, LtSig, date, start)
+    if sig is LeSig:
+        return compare(test, LtSig, date, end)
+    if sig is GtSig:
+        return compare(test, GeSig, date, end)
+    return compare(test, GeSig, date, start)
+
+
+def compare(test: Expr, sig, date: Expr, value: datetime.date) -> Expr:
+    const = ExprConst(
+        value=value,
+        embed=lambda v: sa.cast(sa.literal(v.strftime("%Y-%m-%d")), sa.Date),
+    )
+    return predicate(test, sig, date, const)
+
+
+def predicate(test: Expr, sig, a: Expr, b: Expr) -> Expr:
+    """ Apply binary ``sig`` at the row ``test`` is computed at."""
+    expr = ExprApply(
+        expr=None,
+        args=(a, b),
+        compile=lambda _, args: sig.compile(args[0], args[1]),
+        sig=sig(),
+    )
+    if isinstance(test, ExprOp):
+        return ExprOp(test.op.replace(expr=expr))
+    return expr
+
+
+def and_expr(tests):
+    """ Join ``tests`` with ``AND``."""
+    expr, *rest = tests
+    for test in rest:
+        expr = predicate(expr, AndSig, expr, test)
+    return expr
+
+
+def or_expr(test, a, b):
+    return predicate(test, OrSig, a, b)
+
+
+def prefix_expr(expr: Expr) -> Expr:
+    """
+    Rewrite tests of a string prefix via ``substring(s, 1, n)`` in filter
+    predicate ``expr`` into ``LIKE``, which can use indexes (on
+    ``text_pattern_ops``).
+    """
+    tests = conjuncts(expr)
+    result = [prefix_test(test) or test for test in tests]
+    if all(a is b for a, b in zip(result, tests)):
+        return expr
+    return and_expr(result)
+
+
+def prefix_test(test: Expr) -> Optional[Expr]:
+    """ Rewrite ``substring(s, 1, n) = 'prefix'`` into ``LIKE``."""
+    expr = scalar_expr(test)
+    if not isinstance(expr, ExprApply) or not isinstance(
+        expr.sig, (EqSig, NeSig)
+    ):
+        return None
+    a, b = expr.args
+    if substring_prefix(a) is None:
+        a, b = b, a
+    found = substring_prefix(a)
+    value = const_value(b)
+    # substring() of a shorter string is shorter than n
+    if found is None or not isinstance(value, str):
+        return None
+    string, length = found
+    if len(value) != length:
+        return None
+    pattern = ExprConst(value=like_prefix(value), embed=sa.literal)
+    like = ExprApply(
+        expr=string, args=(pattern,), compile=LikeSig.compile, sig=LikeSig()
+    )
+    if isinstance(expr.sig, NeSig):
+        like = ExprApply(
+            expr=like, args=(), compile=NotSig.compile, sig=NotSig()
+        )
+    if isinstance(test, ExprOp):
+        return ExprOp(test.op.replace(expr=like))
+    return like
+
+
+def substring_prefix(expr: Expr):
+    """ Match ``substring(s, 1, n)`` as ``(s, n)``."""
+    apply, ops = inner_expr(expr)
+    if not isinstance(apply, ExprApply) or not isinstance(
+        apply.sig, SubstringSig
+    ):
+        return None
+    start, length = (const_value(arg) for arg in apply.args)
+    if start != 1 or type(length) is not int or length <= 0:
+        return None
+    return wrap_expr(apply.expr, ops), length
+
+
+def like_prefix(value: str) -> str:
+    """ ``LIKE`` pattern which matches strings starting with ``value``."""
+    for c in ("\\", "%", "_"):
+        value = value.replace(c, "\\" + c)
+    return value + "%"
+
+
+#
+# JSON output
+#
+
+
+def output_json(op: Op):
+    """
+    Build values ``op`` outputs as json rather than jsonb (and composite
+    identities as json arrays).
+
+    Values which are only returned to the client don't need the binary
+    representation, jsonb is kept for values which are compared (filter,
+    sort and group keys, function arguments).
+    """
+    if isinstance(op.sig, JsonAggSig):
+        op = op.replace(sig=JsonAggSig(jsonb=False))
+    expr = op.expr
+    if isinstance(expr, ExprOp):
+        expr = ExprOp(op=(yield output_json(expr.op)))
+    elif isinstance(expr, ExprRecord):
+        fields = {}
+        for name, field in expr.fields.items():
+            fields[name] = field.replace(op=(yield output_json(field.op)))
+        expr = expr.replace(fields=fields, jsonb=False)
+    elif isinstance(expr, ExprIdentity):
+        expr = expr.replace(json=True)
+    return op.replace(expr=expr)
@@ -11,6 +11,7 @@ from __future__ import annotations
 
 import json
 import functools
+import contextvars
 import typing as ty
 
 import sqlalchemy as sa
@@ -41,6 +42,9 @@ from .scope import (
     SyntheticScope,
     type_scope,
 )
+from .base import trampoline
+from . import optimize as optimizer
+from .catalog import Catalog
 from .syntax import (
     Syn,
     Nav,
@@ -53,6 +57,7 @@ from .syntax import (
 )
 from .op import (
     Op,
+    Rel,
     RelVoid,
     RelTable,
     RelJoin,
@@ -76,22 +81,40 @@ from .op import (
 )
 
 
-def plan(syn: Syn, meta: sa.MetaData) -> Op:
-    """ Produce operations from syntax."""
+def plan(syn: Syn, meta: sa.MetaData, optimize=True) -> Op:
+    """
+    Produce operations from syntax.
+
+    Pass ``optimize=False`` to skip rewriting operations into cheaper ones.
+    """
     parent = Op(
         rel=RelVoid(),
         expr=None,
         card=Cardinality.ONE,
-        scope=UnivScope(tables=meta.tables),
+        scope=UnivScope(catalog=Catalog.of(meta)),
         syn=None,
     )
-    return build_op(syn, parent)
+    token = memo.set({})
+    try:
+        op = trampoline(build_op(syn, parent))
+    finally:
+        memo.reset(token)
+    return optimizer.optimize(op) if optimize else op
+
+
+# Per plan memo table for planned select() fields, so that each field is
+# planned once no matter how many times it is referenced.
+memo = contextvars.ContextVar("memo", default=None)
+
+# Planning functions below are generators which yield the planning of
+# subqueries instead of calling it directly (see base.trampoline), this way
+# deeply nested queries don't hit the recursion limit.
 
 
 def build_op(syn: Syn, parent: Op) -> Op:
-    op, k = norm_to_op(syn, parent=parent)
-    op = k(build_op_expr(op))
-    return op
+    op, k = yield norm_to_op(syn, parent=parent)
+    op = yield build_op_expr(op)
+    return k(op)
 
 
 def build_op_expr(op: Op) -> Op:
@@ -100,7 +123,7 @@ def build_op_expr(op: Op) -> Op:
             syn = Apply("select", op.scope.fields)
             fields = {}
             for f in syn.args.values():
-                field_op = build_op(
+                field_op = yield build_op(
                     f.syn,
                     make_parent(op.replace(scope=op.scope.parent)),
                 )
@@ -182,13 +205,43 @@ def to_op(syn: ty.Optional[Syn], parent: Op) -> Op:
 
 
 def run_to_op(syn, parent):
-    op = to_op(syn, parent)
-    return op[1](op[0]) if isinstance(op, tuple) else op
+    op, k = yield norm_to_op(syn, parent)
+    return k(op)
 
 
 def norm_to_op(syn, parent):
-    res = to_op(syn, parent)
-    return res if isinstance(res, tuple) else (res, lambda op: op)
+    res = yield to_op(syn, parent)
+    if isinstance(res, tuple):
+        op, k = res
+        return op, k if isinstance(k, Cont) else Cont(k)
+    return res, Cont()
+
+
+class Cont:
+    """
+    Continuation to apply to an operation once it is built.
+
+    Continuations are composed by concatenating their steps rather than by
+    nesting closures so applying a long chain of them doesn't recurse.
+    """
+
+    __slots__ = ("steps",)
+
+    def __init__(self, *steps):
+        self.steps = steps
+
+    def then(self, k: Cont) -> Cont:
+        """ Continuation which applies this one and then ``k``."""
+        if not self.steps:
+            return k
+        if not k.steps:
+            return self
+        return Cont(*self.steps, *k.steps)
+
+    def __call__(self, op: Op) -> Op:
+        for step in self.steps:
+            op = step(op)
+        return op
 
 
 @to_op.register
@@ -224,13 +277,14 @@ def BinOp_to_op(syn: BinOp, parent: Op):
             expr=None,
             compile=lambda parent, args: sig.compile(args[0], args[1]),
             args=(a, b),
+            sig=sig(),
         )
         return expr
 
-    a, ak = norm_to_op(syn.a, make_parent(parent))
-    a = build_op_expr(a)
-    b, bk = norm_to_op(syn.b, make_parent(parent))
-    b = build_op_expr(b)
+    a, ak = yield norm_to_op(syn.a, make_parent(parent))
+    a = yield build_op_expr(a)
+    b, bk = yield norm_to_op(syn.b, make_parent(parent))
+    b = yield build_op_expr(b)
 
     if a.card > b.card:
         expr = make(a.expr, bk(b))
@@ -257,9 +311,9 @@ def Literal_to_op(syn: Literal, parent: Op):
 
 @to_op.register
 def Compose_to_op(syn: Compose, parent: Op):
-    a, ak = norm_to_op(syn.a, parent)
-    b, bk = norm_to_op(syn.b, a)
-    return b, lambda op: bk(ak(op))
+    a, ak = yield norm_to_op(syn.a, parent)
+    b, bk = yield norm_to_op(syn.b, a)
+    return b, ak.then(bk)
 
 
 @to_op.register
@@ -279,9 +333,10 @@ def navigate(scope: Scope, syn: Nav, parent: Op):
 
 @navigate.register
 def UnivScope_navigate(scope: UnivScope, syn: Nav, parent: Op):
-    table = parent.scope.tables[syn.name]
+    catalog = parent.scope.catalog
+    table = catalog.tables[syn.name].table
     rel = RelTable(table=table)
-    scope = TableScope(rel=rel, table=table)
+    scope = TableScope(rel=rel, table=table, catalog=catalog)
     return Op(
         rel=rel,
         expr=None,
@@ -293,33 +348,62 @@ def UnivScope_navigate(scope: UnivScope, syn: Nav, parent: Op):
 
 @navigate.register
 def TableScope_navigate(scope: TableScope, syn: Nav, parent: Op):
-    table = parent.scope.table
-
-    if syn.name in table.columns:
-        column = table.columns[syn.name]
-        next_scope = type_scope(column.type)
+    info = scope.info
+
+    if syn.name in info.columns:
+        column = info.columns[syn.name]
+        next_scope = info.scopes[syn.name]
+        rel = parent.rel
+        if (
+            parent.expr is None
+            and isinstance(rel, RelJoin)
+            and not isinstance(rel.rel, RelAroundParent)
+            and rel.fk.column is column
+        ):
+            # The column is referenced by the foreign key we've navigated
+            # through, read the foreign key column instead of joining.
+            fk = rel.fk
+            rel = rel.rel
+            if fk.parent.nullable:
+                rel = RelFilter(
+                    rel=rel,
+                    expr=ExprApply(
+                        expr=ExprColumn(column=fk.parent),
+                        args=(),
+                        compile=lambda expr, _args: expr.isnot(None),
+                    ),
+                )
+            return parent.replace(rel=rel).grow_expr(
+                scope=next_scope,
+                expr=ExprColumn(column=fk.parent),
+                syn=syn,
+            )
         return parent.grow_expr(
             scope=next_scope,
             expr=ExprColumn(column=column),
             syn=syn,
         )
 
-    fk = parent.scope.foreign_keys.get(syn.name)
+    fk = info.foreign_keys.get(syn.name)
     if fk:
         assert parent.expr is None, parent.expr
         rel = RelJoin(rel=parent.rel, fk=fk)
-        scope = TableScope(rel=rel, table=fk.column.table)
+        scope = TableScope(
+            rel=rel, table=fk.column.table, catalog=scope.catalog
+        )
         return parent.grow_rel(
             rel=rel,
             scope=scope,
             syn=syn,
         )
 
-    fk = parent.scope.rev_foreign_keys.get(syn.name)
+    fk = info.rev_foreign_keys.get(syn.name)
     if fk:
         assert parent.expr is None, parent.expr
         rel = RelRevJoin(rel=parent.rel, fk=fk)
-        scope = TableScope(rel=rel, table=fk.parent.table)
+        scope = TableScope(
+            rel=rel, table=fk.parent.table, catalog=scope.catalog
+        )
         return parent.grow_rel(
             rel=rel,
             scope=scope,
@@ -336,10 +420,24 @@ def TableScope_navigate(scope: TableScope, syn: Nav, parent: Op):
 def RecordScope_navigate(scope: RecordScope, syn: Nav, parent: Op):
     if syn.name in parent.scope.fields:
         field = parent.scope.fields[syn.name]
-        op = run_to_op(
+        table = memo.get()
+        key = (
             field.syn,
-            parent=make_parent(parent.replace(scope=parent.scope.parent)),
+            id(parent.scope),
+            id(parent.rel),
+            parent.syn,
+            parent.card,
         )
+        if table is not None and key in table:
+            op, _ = table[key]
+        else:
+            op = yield run_to_op(
+                field.syn,
+                parent=make_parent(parent.replace(scope=parent.scope.parent)),
+            )
+            if table is not None:
+                # keep parent around so ids in the key aren't reused
+                table[key] = op, parent
         if op.expr or op.sig:
             return parent.grow_expr(
                 expr=ExprOp(op),
@@ -348,13 +446,6 @@ def RecordScope_navigate(scope: RecordScope, syn: Nav, parent: Op):
             )
         else:
             assert parent.expr is None and parent.sig is None
-
-            def rebase(rel, base):
-                if isinstance(rel, RelParent):
-                    return base
-                else:
-                    return rel.replace(rel=rebase(rel.rel, base))
-
             return parent.grow_rel(
                 rel=rebase(op.rel, parent.rel),
                 card=op.card * parent.card,
@@ -367,6 +458,17 @@ def RecordScope_navigate(scope: RecordScope, syn: Nav, parent: Op):
         ), f"Unable to lookup {syn.name} in record scope, names: {names}"
 
 
+def rebase(rel: Rel, base: Rel) -> Rel:
+    """ Replace ``RelParent`` ``rel`` is based on with ``base``."""
+    path = []
+    while not isinstance(rel, RelParent):
+        path.append(rel)
+        rel = rel.rel
+    for step in reversed(path):
+        base = step.replace(rel=base)
+    return base
+
+
 @navigate.register
 def GroupScope_navigate(scope: GroupScope, syn: Nav, parent: Op):
     if syn.name == "_":
@@ -469,10 +571,12 @@ def AroundSig_to_op(sig: AroundSig, syn: Syn, parent: Op):
     else:
         syn = parent.syn
     if through:
-        on = run_to_op(through, parent.replace(rel=RelAroundParent()))
-        return run_to_op(syn, on)
+        on = yield run_to_op(through, parent.replace(rel=RelAroundParent()))
+        return (yield run_to_op(syn, on))
     else:
-        return run_to_op(parent.syn, parent.replace(card=Cardinality.SEQ))
+        return (
+            yield run_to_op(parent.syn, parent.replace(card=Cardinality.SEQ))
+        )
 
 
 @sig_to_op.register
@@ -480,7 +584,7 @@ def TakeSig_to_op(sig: TakeSig, syn: Syn, parent: Op):
     assert len(syn.args) == 1, "take(...): expected a single argument"
     take = syn.args[0]
     # TODO(andreypopp): this shouldn't be the parent really...
-    take = run_to_op(take, make_parent(parent))
+    take = yield run_to_op(take, make_parent(parent))
     assert parent.card >= Cardinality.SEQ
     assert take.card == Cardinality.ONE
     rel = RelTake(rel=parent.rel, take=ExprOp(take))
@@ -490,7 +594,7 @@ def TakeSig_to_op(sig: TakeSig, syn: Syn, parent: Op):
 @sig_to_op.register
 def FirstSig_to_op(sig: FirstSig, syn: Syn, parent: Op):
     assert len(syn.args) == 0, "first(): expected no arguments"
-    take = run_to_op(make_value(1), make_parent(parent))
+    take = yield run_to_op(make_value(1), make_parent(parent))
     assert parent.card >= Cardinality.SEQ
     assert take.card >= Cardinality.ONE
     rel = RelTake(rel=parent.rel, take=ExprOp(take))
@@ -504,7 +608,7 @@ def FilterSig_to_op(sig: FilterSig, syn: Syn, parent: Op):
     assert (
         parent.card >= Cardinality.SEQ
     ), f"{syn.name}(...): expected a sequence of items"
-    expr = run_to_op(expr, make_parent(parent))
+    expr = yield run_to_op(expr, make_parent(parent))
     rel = RelFilter(rel=parent.rel, expr=ExprOp(expr))
     return parent.grow_rel(rel=rel, syn=syn)
 
@@ -515,8 +619,10 @@ def SortSig_to_op(sig: SortSig, syn: Syn, parent: Op):
     sort = []
     for arg in syn.args:
         arg, desc = (arg.syn, True) if isinstance(arg, Desc) else (arg, False)
-        arg = run_to_op(arg, make_parent(parent))
+        arg = yield run_to_op(arg, make_parent(parent))
         assert arg.card == Cardinality.ONE
+        if arg.expr is None and isinstance(arg.scope, TableScope):
+            arg = arg.grow_expr(ExprIdentity(table=arg.scope.table))
         sort.append(Sort(expr=ExprOp(arg), desc=desc))
     rel = RelSort(rel=parent.rel, sort=sort)
     return parent.grow_rel(rel=rel, syn=syn)
@@ -530,7 +636,7 @@ def GroupSig_to_op(sig: GroupSig, syn: Syn, parent: Op):
     # TODO(andreypopp): fix usage of syn.args here
     fields = {}
     for name, f in syn.args.items():
-        op = run_to_op(f.syn, make_parent(parent))
+        op = yield run_to_op(f.syn, make_parent(parent))
         if op.expr is None:
             if isinstance(op.scope, TableScope):
                 op = op.grow_expr(ExprIdentity(table=op.scope.table))
@@ -546,15 +652,21 @@ def GroupSig_to_op(sig: GroupSig, syn: Syn, parent: Op):
 def FuncSig_to_op(sig: FuncSig, syn: Apply, parent: Op):
     args = []
     for arg in syn.args:
-        arg = run_to_op(arg, make_parent(parent))
+        arg = yield run_to_op(arg, make_parent(parent))
         assert arg.card == Cardinality.ONE
         args.append(ExprOp(arg))
     sig.validate(args)
 
+    expr = parent.expr
+    if parent.sig is not None:
+        # Function is applied to the value of an aggregate.
+        expr = ExprOp(parent)
+        parent = make_parent(parent)
     expr = ExprApply(
-        expr=parent.expr,
+        expr=expr,
         compile=sig.compile,
         args=args,
+        sig=sig,
     )
     return parent.grow_expr(expr, syn=syn)
 
@@ -16,12 +16,18 @@ from . import syntax
 from .scope import Cardinality
 from .plan import plan
 from .compile import compile
+from .route import execute
 
 __all__ = ("Q",)
 
 
 class Q:
-    """ Python API for querying data."""
+    """
+    Python API for querying data.
+
+    Queries are executed with ``engine`` which is either an
+    ``sqlalchemy`` engine or a :class:`qc0.route.Routing` policy.
+    """
 
     def __init__(self, meta: sa.MetaData, engine: sa.engine.Engine, syn=None):
         self.meta = meta
@@ -161,16 +167,18 @@ class Q:
     # Execution API
     #
 
-    def run(self):
-        """ Execute query and return result."""
+    def run(self, on=None):
+        """
+        Execute query and return result.
+
+        Pass ``on="primary"`` or ``on="replica"`` to override routing.
+        """
         op = plan(self.syn, self.meta)
         sql = compile(op)
-        with self.engine.connect() as conn:
-            res = conn.execute(sql)
-            value = [row.value for row in res.fetchall()]
-            if op.card != Cardinality.SEQ:
-                value = value[0]
-            return value
+        value = [row.value for row in execute(self.engine, sql, on=on)]
+        if op.card != Cardinality.SEQ:
+            value = value[0]
+        return value
 
     @property
     def sql(self):
@@ -198,7 +206,10 @@ class Q:
         """ Get generated SQL query."""
         op = plan(self.syn, self.meta)
         sql = compile(op)
-        sql = sql.compile(self.engine, compile_kwargs={"literal_binds": True})
+        sql = sql.compile(
+            dialect=self.engine.dialect,
+            compile_kwargs={"literal_binds": True},
+        )
         sql = str(sql).strip()
         sql = "\n".join([line.strip() for line in sql.split("\n")])
         if format:
@@ -0,0 +1,344 @@
+"""
+
+    qc0.route
+    =========
+
+    This module implements routing of query execution between a primary
+    database and its read replicas.
+
+"""
+
+from __future__ import annotations
+
+import math
+import time
+import itertools
+import threading
+import contextlib
+import collections
+from concurrent import futures
+from functools import singledispatch
+from typing import Optional
+
+import sqlalchemy as sa
+
+from .base import Struct
+
+__all__ = ("Routing", "Hedging", "HedgingStats", "execute")
+
+SELECT = ("round_robin", "least_busy")
+ON = (None, "primary", "replica")
+
+
+class Routing:
+    """
+    Routing policy for query execution.
+
+    Queries are executed on one of the ``replicas`` picked according to the
+    ``select`` policy (either ``"round_robin"`` or ``"least_busy"``), unless
+    routed explicitly with ``on="primary"``.
+
+    If ``max_lag`` (in seconds) is specified then replicas which lag behind
+    the primary more than that are skipped. If no replica is fresh enough
+    then the query is executed on the primary (or fails if ``on="replica"``
+    was requested).
+
+    Pass a :class:`Hedging` policy as ``hedge`` to hedge queries routed to
+    replicas.
+    """
+
+    def __init__(
+        self,
+        primary: sa.engine.Engine,
+        replicas=(),
+        select="round_robin",
+        max_lag=None,
+        hedge: Optional[Hedging] = None,
+    ):
+        if select not in SELECT:
+            raise ValueError(f"unknown replica selection policy {select!r}")
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.select = select
+        self.max_lag = max_lag
+        self.hedge = hedge
+        self._lock = threading.Lock()
+        self._next = itertools.count()
+        self._busy = [0] * len(self.replicas)
+
+    @property
+    def dialect(self):
+        return self.primary.dialect
+
+    @contextlib.contextmanager
+    def connect(self, on=None, exclude=(), picked=None):
+        """
+        Connect to an engine chosen for the query.
+
+        The connection is yielded along with the index of the replica it
+        belongs to (``None`` for the primary), replicas with indices from
+        ``exclude`` are not considered. If given, ``picked`` is called with
+        the index of each replica before connecting to it.
+        """
+        conn, idx = self._acquire(on, exclude, picked)
+        try:
+            yield conn, idx
+        finally:
+            conn.close()
+            if idx is not None:
+                self._release(idx)
+
+    def candidates(self):
+        """ Replica indices in the order they should be tried."""
+        if not self.replicas:
+            return []
+        if self.select == "least_busy":
+            with self._lock:
+                busy = list(self._busy)
+            return sorted(range(len(self.replicas)), key=lambda i: busy[i])
+        start = next(self._next) % len(self.replicas)
+        return [
+            (start + n) % len(self.replicas) for n in range(len(self.replicas))
+        ]
+
+    def _acquire(self, on, exclude, picked=None):
+        if on not in ON:
+            raise ValueError(f"unknown route {on!r}, expected one of {ON}")
+        if on != "primary":
+            for idx in self.candidates():
+                if idx in exclude:
+                    continue
+                with self._lock:
+                    self._busy[idx] += 1
+                if picked is not None:
+                    picked(idx)
+                conn = None
+                try:
+                    conn = self.replicas[idx].connect()
+                    if self.max_lag is None or lag(conn) <= self.max_lag:
+                        return conn, idx
+                except sa.exc.SQLAlchemyError:
+                    # unreachable replica, try the next one
+                    pass
+                try:
+                    if conn is not None:
+                        conn.close()
+                finally:
+                    self._release(idx)
+            if on == "replica":
+                reason = (
+                    "reachable"
+                    if self.max_lag is None
+                    else f"lagging less than {self.max_lag}s"
+                )
+                raise RuntimeError(f"no replica is {reason}")
+        return self.primary.connect(), None
+
+    def _release(self, idx):
+        with self._lock:
+            self._busy[idx] -= 1
+
+
+def lag(conn) -> float:
+    """
+    Replication lag (in seconds) of the database behind ``conn``.
+
+    A database which is not a standby (or hasn't replayed anything yet) is
+    considered to have no lag.
+    """
+    value = conn.execute(
+        sa.text(
+            "SELECT EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())"
+        )
+    ).scalar()
+    return 0.0 if value is None else float(value)
+
+
+@singledispatch
+def execute(engine, sql, on=None):
+    """ Execute ``sql`` and fetch all resulting rows."""
+    raise NotImplementedError(  # pragma: no cover
+        f"unable to execute queries with {type(engine)}"
+    )
+
+
+@execute.register
+def Engine_execute(engine: sa.engine.Engine, sql, on=None):
+    if on == "replica":
+        raise ValueError("unable to route to replica without replicas")
+    with engine.connect() as conn:
+        return conn.execute(sql).fetchall()
+
+
+@execute.register
+def Routing_execute(engine: Routing, sql, on=None):
+    if engine.hedge is not None and on != "primary":
+        return engine.hedge.execute(engine, sql, on=on)
+    with engine.connect(on=on) as (conn, _idx):
+        return conn.execute(sql).fetchall()
+
+
+class HedgingStats(Struct):
+    """
+    Hedging statistics.
+
+    Out of ``executed`` queries a hedge was ``fired`` for some of them and the
+    hedge ``won`` (answered before the original request) for some of those.
+    """
+
+    executed: int
+    fired: int
+    won: int
+
+
+class Hedging:
+    """
+    Hedging policy for read-only queries.
+
+    If the engine a query was routed to hasn't answered within the
+    ``percentile`` of the recent latencies (the last ``window`` ones, at least
+    ``min_samples`` of them) of the same query then the same statement is
+    issued to another engine. The first response wins and the other request
+    is cancelled.
+
+    Queries are identified by their compiled statement with literals replaced
+    by parameters.
+    """
+
+    def __init__(self, percentile=95, window=100, min_samples=10):
+        if not 0 < percentile <= 100:
+            raise ValueError("percentile should be in (0, 100]")
+        self.percentile = percentile
+        self.window = window
+        self.min_samples = max(min_samples, 1)
+        self.latencies = {}
+        self.executed = 0
+        self.fired = 0
+        self.won = 0
+        self._lock = threading.Lock()
+        self._pool = futures.ThreadPoolExecutor(thread_name_prefix="qc0-hedge")
+
+    def close(self):
+        """ Shut down threads which execute queries."""
+        self._pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def stats(self) -> HedgingStats:
+        with self._lock:
+            return HedgingStats(
+                executed=self.executed, fired=self.fired, won=self.won
+            )
+
+    def delay(self, fingerprint) -> Optional[float]:
+        """ Time to wait before hedging the query (if it is known yet)."""
+        with self._lock:
+            latencies = sorted(self.latencies.get(fingerprint, ()))
+        if len(latencies) < self.min_samples:
+            return None
+        idx = math.ceil(self.percentile / 100 * len(latencies)) - 1
+        return latencies[idx]
+
+    def record(self, fingerprint, latency, fired=False, won=False):
+        with self._lock:
+            if fingerprint not in self.latencies:
+                self.latencies[fingerprint] = collections.deque(
+                    maxlen=self.window
+                )
+            self.latencies[fingerprint].append(latency)
+            self.executed += 1
+            self.fired += fired
+            self.won += won
+
+    def execute(self, routing: Routing, sql, on=None):
+        fingerprint = str(sql.compile(dialect=routing.dialect))
+        delay = self.delay(fingerprint)
+
+        first = Attempt(routing, sql, on)
+        first.future = self._pool.submit(first.run)
+        if delay is None:
+            rows = first.future.result()
+            self.record(fingerprint, first.latency)
+            return rows
+
+        done, _ = futures.wait([first.future], timeout=delay)
+        if done:
+            rows = first.future.result()
+            self.record(fingerprint, first.latency)
+            return rows
+
+        # Hedge to another replica than the first attempt picked (it might
+        # still be connecting to it).
+        exclude = () if first.idx is None else (first.idx,)
+        second = Attempt(routing, sql, on, exclude=exclude)
+        second.future = self._pool.submit(second.run)
+        attempts = [first, second]
+        done, _ = futures.wait(
+            [a.future for a in attempts], return_when=futures.FIRST_COMPLETED
+        )
+        winner = first if first.future in done else second
+        loser = second if winner is first else first
+        if winner.future.exception() is not None:
+            # The first response is an error, let's see what the other one
+            # has to say.
+            winner, loser = loser, winner
+        loser.cancel()
+        rows = winner.future.result()
+        # Latency of the query as seen by the caller.
+        latency = winner.finished - first.started
+        self.record(fingerprint, latency, fired=True, won=winner is second)
+        return rows
+
+
+class Attempt:
+    """ A single (possibly cancelled) attempt to execute a query."""
+
+    def __init__(self, routing, sql, on, exclude=()):
+        self.routing = routing
+        self.sql = sql
+        self.on = on
+        self.exclude = exclude
+        # Replica picked for the attempt (as soon as it is picked).
+        self.idx = None
+        self.conn = None
+        self.started = time.monotonic()
+        self.finished = None
+        self.future = None
+        self.cancelled = False
+        self._lock = threading.Lock()
+
+    @property
+    def latency(self):
+        return self.finished - self.started
+
+    def run(self):
+        try:
+            with self.routing.connect(
+                self.on, self.exclude, picked=self.pick
+            ) as (conn, idx):
+                with self._lock:
+                    if self.cancelled:
+                        raise futures.CancelledError()
+                    self.conn, self.idx = conn, idx
+                try:
+                    rows = conn.execute(self.sql).fetchall()
+                finally:
+                    with self._lock:
+                        self.conn = None
+        finally:
+            self.finished = time.monotonic()
+        return rows
+
+    def pick(self, idx):
+        self.idx = idx
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            if self.conn is not None:
+                self.conn.connection.cancel()
@@ -43,7 +43,10 @@ class UnivScope(Scope):
     One can navigate to any db tables from this point.
     """
 
-    tables: Dict[str, sa.Table]
+    catalog: Any
+
+    def __yaml__(self):
+        return {"tables": list(self.catalog.tables)}
 
 
 class TableScope(Scope):
@@ -56,21 +59,19 @@ class TableScope(Scope):
 
     rel: Any
     table: sa.Table
+    catalog: Any
+
+    @property
+    def info(self):
+        return self.catalog.info(self.table)
 
     @property
     def foreign_keys(self):
-        return {fk.column.table.name: fk for fk in self.table.foreign_keys}
+        return self.info.foreign_keys
 
     @property
     def rev_foreign_keys(self):
-        # TODO(andreypopp): this is silly to do on each lookup, we should
-        # organize this better
-        return {
-            fk.parent.table.name: fk
-            for t in self.table.metadata.tables.values()
-            for fk in t.foreign_keys
-            if fk.column.table == self.table
-        }
+        return self.info.rev_foreign_keys
 
     def __yaml__(self):
         return {"table": str(self.table.name)}
@@ -139,9 +140,23 @@ class DateScope(SyntheticScope):
     """
 
     def lookup(self, name):
-        if name not in {"year", "month", "year"}:
+        if name not in {"year", "month", "day"}:
             raise LookupError(name)
-        return lambda expr, _args: sa.extract(name, expr), sa.Integer()
+        return DatePart(part=name), sa.Integer()
+
+
+class DatePart(Struct):
+    """
+    Compiles ``part`` of a date.
+
+    This is a struct (rather than a function) so that the optimizer can
+    recognize comparisons of date parts.
+    """
+
+    part: str
+
+    def __call__(self, expr, _args):
+        return sa.extract(self.part, expr)
 
 
 @singledispatch
@@ -84,7 +84,20 @@ class AggrSig(Sig):
 
 class JsonAggSig(AggrSig):
     name = "jsonb_agg"
-    unit = sa.func.cast(sa.literal("[]"), sa.dialects.postgresql.JSONB())
+
+    def __init__(self, jsonb=True):
+        # jsonb is needed only if the value is compared, otherwise json is
+        # cheaper to build.
+        self.jsonb = jsonb
+
+    @property
+    def unit(self):
+        type = sa.dialects.postgresql.JSONB if self.jsonb else sa.JSON
+        return sa.func.cast(sa.literal("[]"), type())
+
+    def compile(self, args):
+        func = sa.func.jsonb_agg if self.jsonb else sa.func.json_agg
+        return func(*args)
 
 
 class CountSig(AggrSig):
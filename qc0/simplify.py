@@ -0,0 +1,285 @@
+"""
+
+    qc0.simplify
+    ============
+
+    Simplify SQL produced by the compiler.
+
+    The compiler wraps relations into subqueries whenever it isn't sure it can
+    extend them in place (e.g. after ``LIMIT``), this module merges such
+    subqueries back into the enclosing ``SELECT`` where it is safe to do so.
+    It runs once over the compiled statement.
+
+"""
+
+from sqlalchemy.sql import visitors
+from sqlalchemy.sql.selectable import Select, Alias, Lateral, CTE
+from sqlalchemy.sql.elements import ColumnClause, Label, Over
+from sqlalchemy.sql.functions import FunctionElement
+
+from .sig import Sig, AggrSig
+
+
+def aggregate_names():
+    names = set()
+    for sig in Sig.registry().values():
+        if issubclass(sig, AggrSig):
+            names.add(sig.func or sig.name)
+    return names | {"json_agg"}
+
+
+AGGREGATES = aggregate_names()
+
+
+def simplify(sel: Select) -> Select:
+    """
+    Merge subqueries of ``sel`` into the ``SELECT`` statements reading from
+    them.
+
+    This is a single pass over ``sel``: each subquery is simplified once,
+    before the statements which refer to it, and those are rebuilt only if
+    something they refer to has changed.
+    """
+    done = {}
+    dependencies = {}
+    stack = [sel]
+    while stack:
+        element = stack[-1]
+        if id(element) in done:
+            stack.pop()
+            continue
+        if id(element) not in dependencies:
+            dependencies[id(element)] = list(subqueries(element))
+            stack.extend(
+                dep for dep in dependencies[id(element)] if id(dep) not in done
+            )
+            continue
+        stack.pop()
+        done[id(element)] = rebuild(element, dependencies[id(element)], done)
+    return done[id(sel)]
+
+
+def subqueries(element):
+    """
+    Subqueries and aliases ``element`` refers to directly (that is, not
+    through other subqueries).
+    """
+    seen = set()
+    stack = list(children(element))
+    while stack:
+        node = stack.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        if isinstance(node, ColumnClause):
+            table = node.table
+            if isinstance(table, (Select, Alias)) and table is not element:
+                stack.append(table)
+        elif isinstance(node, (Select, Alias)):
+            yield node
+        else:
+            stack.extend(node.get_children(column_collections=False))
+
+
+def children(element):
+    """ Elements ``element`` consists of (for an alias, what it aliases)."""
+    if isinstance(element, Alias):
+        return [element.element]
+    return element.get_children(column_collections=False)
+
+
+def rebuild(element, dependencies, done):
+    """
+    Rebuild ``element`` to refer to simplified ``dependencies``, then merge
+    the subquery it selects from into it.
+    """
+    changed = {
+        id(dep): done[id(dep)]
+        for dep in dependencies
+        if done[id(dep)] is not dep
+    }
+
+    def replace(node):
+        if node is element:
+            return None
+        if isinstance(node, (Select, Alias)):
+            return done.get(id(node), node)
+        if isinstance(node, ColumnClause) and id(node.table) in changed:
+            return changed[id(node.table)].c[node.key]
+        return None
+
+    if changed:
+        element = visitors.replacement_traverse(element, {}, replace)
+    if isinstance(element, Select):
+        element = merge(element)
+    return element
+
+
+def merge(sel: Select) -> Select:
+    """
+    Merge the subquery ``sel`` selects from into ``sel`` itself.
+
+    This is safe only if nothing else references the subquery, which is the
+    case for subqueries the compiler produces.
+    """
+    froms = sel._from_obj
+    if len(froms) != 1:
+        return sel
+    (alias,) = froms
+    if not isinstance(alias, Alias) or isinstance(alias, (Lateral, CTE)):
+        return sel
+    inner = alias.element
+    while isinstance(inner, Alias) and not isinstance(inner, (Lateral, CTE)):
+        inner = inner.element
+    if not isinstance(inner, Select) or not is_plain(inner):
+        return sel
+    if sel._group_by_clause.clauses or sel._having is not None:
+        return sel
+    if sel._distinct or sel._offset_clause is not None:
+        return sel
+
+    parts = [*sel._raw_columns, *sel._order_by_clause.clauses]
+    if sel._whereclause is not None:
+        parts.append(sel._whereclause)
+    if any(not is_scalar(part, alias) for part in parts):
+        return sel
+
+    # WHERE, ORDER BY and LIMIT of the outer query apply to the inner rows
+    # only if those are not limited or aggregated.
+    restricts = (
+        sel._whereclause is not None
+        or sel._order_by_clause.clauses
+        or sel._limit_clause is not None
+    )
+    if restricts and (
+        inner._limit_clause is not None
+        or inner._offset_clause is not None
+        or inner._group_by_clause.clauses
+        or inner._having is not None
+        or not all(is_scalar(c, None) for c in inner._raw_columns)
+    ):
+        return sel
+    if sel._order_by_clause.clauses and inner._order_by_clause.clauses:
+        return sel
+
+    inner_columns = {}
+    for column in inner.inner_columns:
+        name = getattr(column, "name", None)
+        if name is None:
+            return sel
+        if isinstance(column, Label):
+            column = column.element
+        if inner_columns.setdefault(name, column) is not column:
+            return sel
+
+    def replace(element):
+        if isinstance(element, ColumnClause) and element.table is alias:
+            return inner_columns.get(element.name)
+        return None
+
+    def substitute(element):
+        def replace_column(node):
+            if isinstance(node, (Select, Alias)) and not refers_to(
+                node, alias
+            ):
+                # keep subqueries which don't correlate to the alias as is
+                return node
+            return replace(node)
+
+        return visitors.replacement_traverse(element, {}, replace_column)
+
+    columns = []
+    for column in sel._raw_columns:
+        if column is alias:
+            columns.extend(inner.inner_columns)
+        elif isinstance(column, ColumnClause) and column.table is alias:
+            # keep the name the column is selected under
+            columns.append(substitute(column).label(column.name))
+        else:
+            columns.append(substitute(column))
+    where = sel._whereclause
+    if where is not None:
+        where = substitute(where)
+    order = [substitute(c) for c in sel._order_by_clause.clauses]
+    parts = [*columns, *order] if where is None else [*columns, *order, where]
+    if any(refers_to(part, alias) for part in parts):
+        return sel
+
+    result = inner.with_only_columns(columns)
+    if where is not None:
+        result = result.where(where)
+    if order:
+        result = result.order_by(*order)
+    if sel._limit_clause is not None:
+        result = result.limit(sel._limit_clause)
+    if sel._correlate:
+        result = result.correlate(*sel._correlate)
+    return result
+
+
+def refers_to(element, alias) -> bool:
+    """ Check if ``element`` references ``alias`` or its columns."""
+    for node in walk(element, alias):
+        if node is alias:
+            return True
+        if isinstance(node, ColumnClause) and node.table is alias:
+            return True
+    return False
+
+
+def walk(element, stop=None):
+    """
+    Iterate over ``element`` and everything it contains, each once, without
+    descending into ``stop``.
+    """
+    seen = set()
+    stack = [element]
+    while stack:
+        node = stack.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        yield node
+        if node is not stop:
+            stack.extend(children(node))
+
+
+def is_plain(sel: Select) -> bool:
+    """ Check if ``sel`` rows are not deduplicated or locked."""
+    return not sel._distinct and sel._for_update_arg is None
+
+
+def is_scalar(element, alias) -> bool:
+    """
+    Check if ``element`` computes a value per row: it doesn't aggregate,
+    isn't a window function and doesn't have subqueries (other than the
+    ``alias`` being merged).
+    """
+    for node in walk(element, alias):
+        if isinstance(node, Over):
+            return False
+        if isinstance(node, FunctionElement) and node.name in AGGREGATES:
+            return False
+        if isinstance(node, Select) or (
+            isinstance(node, Alias) and node is not alias
+        ):
+            return False
+    return True
+
+
+def nesting_depth(sel) -> int:
+    """ Maximum number of nested ``SELECT`` statements in ``sel``."""
+    depth = 0
+    stack = [(sel, 0)]
+    seen = set()
+    while stack:
+        element, level = stack.pop()
+        if id(element) in seen:
+            continue
+        seen.add(id(element))
+        if isinstance(element, Select):
+            level += 1
+            depth = max(depth, level)
+        for child in element.get_children():
+            stack.append((child, level))
+    return depth
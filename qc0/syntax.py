@@ -9,6 +9,9 @@
 
 from __future__ import annotations
 
+import threading
+import weakref
+import dataclasses
 from functools import singledispatch
 from datetime import date
 from typing import Dict, List, Union, Any
@@ -16,11 +19,73 @@ from typing import Dict, List, Union, Any
 import sqlalchemy as sa
 import sqlalchemy.dialects.postgresql as sa_pg
 
-from .base import Struct
+from .base import Struct, StructMeta
 
 
-class Syn(Struct):
-    """ Base class for representing syntax."""
+class SynMeta(StructMeta):
+    """
+    Metaclass for syntax nodes which makes their constructors interning.
+
+    Structurally equal syntax trees are represented by the same instance so
+    that equality is an identity check and hashing doesn't need to traverse
+    the tree.
+    """
+
+    eq = False
+
+    def __call__(cls, *args, **kwargs):
+        names = [f.name for f in dataclasses.fields(cls)]
+        values = {**dict(zip(names, args)), **kwargs}
+        key = (cls, *(intern_key(values.get(name)) for name in names))
+        with _interned_lock:
+            syn = _interned.get(key)
+            if syn is None:
+                syn = super().__call__(*args, **kwargs)
+                object.__setattr__(syn, "_hash", hash(key))
+                _interned[key] = syn
+        return syn
+
+
+_interned = weakref.WeakValueDictionary()
+_interned_lock = threading.RLock()
+
+
+def intern_key(v):
+    """ Key which identifies a value inside an interned syntax node."""
+    if isinstance(v, Syn):
+        # Syntax nodes are interned already.
+        return v
+    if isinstance(v, Struct):
+        fields = dataclasses.fields(v)
+        return (type(v), *(intern_key(getattr(v, f.name)) for f in fields))
+    if isinstance(v, dict):
+        return (dict, *((k, intern_key(kv)) for k, kv in v.items()))
+    if isinstance(v, (list, tuple)):
+        return (list, *(intern_key(iv) for iv in v))
+    if isinstance(v, sa.types.TypeEngine):
+        return (type(v), repr(v))
+    try:
+        hash(v)
+    except TypeError:
+        return (type(v), id(v))
+    return (type(v), v)
+
+
+class Syn(Struct, metaclass=SynMeta):
+    """
+    Base class for representing syntax.
+
+    Syntax nodes are interned (see ``SynMeta``) and thus are compared by
+    identity.
+    """
+
+    __slots__ = ("__weakref__", "_hash")
+
+    def __eq__(self, o):
+        return self is o
+
+    def __hash__(self):
+        return self._hash
 
 
 class Nav(Syn):
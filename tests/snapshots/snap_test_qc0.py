@@ -138,31 +138,31 @@ snapshots[
 
 snapshots[
     "test_back_nav_region_nation_ok 1"
-] = """- (ALGERIA)
-- (ARGENTINA)
-- (BRAZIL)
-- (CANADA)
-- (EGYPT)
-- (ETHIOPIA)
-- (FRANCE)
-- (GERMANY)
-- (INDIA)
-- (INDONESIA)
-- (IRAN)
-- (IRAQ)
-- (JAPAN)
-- (JORDAN)
-- (KENYA)
-- (MOROCCO)
-- (MOZAMBIQUE)
-- (PERU)
-- (CHINA)
-- (ROMANIA)
-- ("SAUDI ARABIA")
-- (VIETNAM)
-- (RUSSIA)
-- ("UNITED KINGDOM")
-- ("UNITED STATES")
+] = """- ALGERIA
+- ARGENTINA
+- BRAZIL
+- CANADA
+- EGYPT
+- ETHIOPIA
+- FRANCE
+- GERMANY
+- INDIA
+- INDONESIA
+- IRAN
+- IRAQ
+- JAPAN
+- JORDAN
+- KENYA
+- MOROCCO
+- MOZAMBIQUE
+- PERU
+- CHINA
+- ROMANIA
+- SAUDI ARABIA
+- VIETNAM
+- RUSSIA
+- UNITED KINGDOM
+- UNITED STATES
 """
 
 snapshots[
@@ -304,6 +304,25 @@ snapshots[
 ...
 """
 
+snapshots[
+    "test_cse_aggregate_ok 1"
+] = """- a: 5
+  b: 6
+  name: AFRICA
+- a: 5
+  b: 6
+  name: AMERICA
+- a: 5
+  b: 6
+  name: ASIA
+- a: 5
+  b: 6
+  name: EUROPE
+- a: 5
+  b: 6
+  name: MIDDLE EAST
+"""
+
 snapshots[
     "test_date_literal_nav_ok 1"
 ] = """2020.0
@@ -322,18 +341,39 @@ snapshots[
 ...
 """
 
+snapshots[
+    "test_filter_exists_ok 1"
+] = """- AFRICA
+- AMERICA
+- EUROPE
+- MIDDLE EAST
+"""
+
+snapshots[
+    "test_filter_group_having_ok 1"
+] = """- AMERICA
+- EUROPE
+- MIDDLE EAST
+"""
+
+snapshots[
+    "test_filter_group_key_pushdown_ok 1"
+] = """- c: 5
+  r: AFRICA
+"""
+
 snapshots[
     "test_filter_multiple_ok 1"
-] = """- (AFRICA)
+] = """- AFRICA
 """
 
 snapshots[
     "test_filter_nation_by_region_name_ok 1"
-] = """- (ALGERIA)
-- (ETHIOPIA)
-- (KENYA)
-- (MOROCCO)
-- (MOZAMBIQUE)
+] = """- ALGERIA
+- ETHIOPIA
+- KENYA
+- MOROCCO
+- MOZAMBIQUE
 """
 
 snapshots[
@@ -345,9 +385,14 @@ snapshots[
 - MOZAMBIQUE
 """
 
+snapshots[
+    "test_filter_not_exists_ok 1"
+] = """- ASIA
+"""
+
 snapshots[
     "test_filter_region_by_name_ok 1"
-] = """- (AFRICA)
+] = """- AFRICA
 """
 
 snapshots[
@@ -368,11 +413,11 @@ snapshots[
 
 snapshots[
     "test_filter_region_by_nation_count_ok 1"
-] = """- (AFRICA)
-- (AMERICA)
-- (ASIA)
-- (EUROPE)
-- ("MIDDLE EAST")
+] = """- AFRICA
+- AMERICA
+- ASIA
+- EUROPE
+- MIDDLE EAST
 """
 
 snapshots[
@@ -382,14 +427,14 @@ snapshots[
 
 snapshots[
     "test_filter_sort_ok 1"
-] = """- (ASIA)
-- (AMERICA)
-- (AFRICA)
+] = """- ASIA
+- AMERICA
+- AFRICA
 """
 
 snapshots[
     "test_filter_take_ok 1"
-] = """- (AFRICA)
+] = """- AFRICA
 """
 
 snapshots[
@@ -406,13 +451,22 @@ snapshots[
   - EUROPE!
 """
 
+snapshots[
+    "test_group_by_fk_column_no_join_ok 1"
+] = """- c: 5
+- c: 5
+- c: 5
+- c: 5
+- c: 5
+"""
+
 snapshots[
     "test_group_by_link_ok 1"
-] = """- n: (ASIA)
-- n: ("MIDDLE EAST")
-- n: (AMERICA)
-- n: (EUROPE)
-- n: (AFRICA)
+] = """- n: ASIA
+- n: AFRICA
+- n: MIDDLE EAST
+- n: AMERICA
+- n: EUROPE
 """
 
 snapshots[
@@ -462,21 +516,21 @@ snapshots[
 
 snapshots[
     "test_group_nation_by_region_select_aggr_col_and_link_ok 1"
-] = """- customer_count: 253
+] = """- customer_count: 23
   nation_count: 5
   ref: ASIA
-- customer_count: 243
-  nation_count: 5
-  ref: AFRICA
-- customer_count: 252
-  nation_count: 5
-  ref: MIDDLE EAST
-- customer_count: 232
+- customer_count: 20
   nation_count: 5
   ref: AMERICA
-- customer_count: 220
+- customer_count: 34
   nation_count: 5
   ref: EUROPE
+- customer_count: 32
+  nation_count: 5
+  ref: AFRICA
+- customer_count: 41
+  nation_count: 5
+  ref: MIDDLE EAST
 """
 
 snapshots[
@@ -495,16 +549,16 @@ snapshots[
 
 snapshots[
     "test_group_nation_by_region_select_aggr_link_ok 1"
-] = """- customer_count: 253
+] = """- customer_count: 23
   ref: ASIA
-- customer_count: 243
-  ref: AFRICA
-- customer_count: 252
-  ref: MIDDLE EAST
-- customer_count: 232
+- customer_count: 20
   ref: AMERICA
-- customer_count: 220
+- customer_count: 34
   ref: EUROPE
+- customer_count: 32
+  ref: AFRICA
+- customer_count: 41
+  ref: MIDDLE EAST
 """
 
 snapshots[
@@ -633,6 +687,25 @@ snapshots[
 - world
 """
 
+snapshots[
+    "test_json_output_jsonb_compare_ok 1"
+] = """- name: INDIA
+  r:
+    n: ASIA
+- name: INDONESIA
+  r:
+    n: ASIA
+- name: JAPAN
+  r:
+    n: ASIA
+- name: CHINA
+  r:
+    n: ASIA
+- name: VIETNAM
+  r:
+    n: ASIA
+"""
+
 snapshots[
     "test_literal_boolean_ok 1"
 ] = """true
@@ -675,6 +748,35 @@ snapshots[
 ...
 """
 
+snapshots[
+    "test_merge_aggregates_ok 1"
+] = """- first:
+  - ALGERIA
+  m: 11
+  n: 5
+  name: AFRICA
+- first:
+  - ARGENTINA
+  m: 14
+  n: 5
+  name: AMERICA
+- first:
+  - INDIA
+  m: 10
+  n: 5
+  name: ASIA
+- first:
+  - FRANCE
+  m: 15
+  n: 5
+  name: EUROPE
+- first:
+  - EGYPT
+  m: 13
+  n: 5
+  name: MIDDLE EAST
+"""
+
 snapshots[
     "test_mul_integer_literals_ok 1"
 ] = """44
@@ -712,31 +814,31 @@ snapshots[
 
 snapshots[
     "test_nav_nation_ok 1"
-] = """- (ALGERIA)
-- (ARGENTINA)
-- (BRAZIL)
-- (CANADA)
-- (EGYPT)
-- (ETHIOPIA)
-- (FRANCE)
-- (GERMANY)
-- (INDIA)
-- (INDONESIA)
-- (IRAN)
-- (IRAQ)
-- (JAPAN)
-- (JORDAN)
-- (KENYA)
-- (MOROCCO)
-- (MOZAMBIQUE)
-- (PERU)
-- (CHINA)
-- (ROMANIA)
-- ("SAUDI ARABIA")
-- (VIETNAM)
-- (RUSSIA)
-- ("UNITED KINGDOM")
-- ("UNITED STATES")
+] = """- ALGERIA
+- ARGENTINA
+- BRAZIL
+- CANADA
+- EGYPT
+- ETHIOPIA
+- FRANCE
+- GERMANY
+- INDIA
+- INDONESIA
+- IRAN
+- IRAQ
+- JAPAN
+- JORDAN
+- KENYA
+- MOROCCO
+- MOZAMBIQUE
+- PERU
+- CHINA
+- ROMANIA
+- SAUDI ARABIA
+- VIETNAM
+- RUSSIA
+- UNITED KINGDOM
+- UNITED STATES
 """
 
 snapshots[
@@ -838,6 +940,17 @@ snapshots[
     - SAUDI ARABIA
     r2: SA
   r1: S
+- names:
+  - EGYPT
+  - ETHIOPIA
+  nested:
+  - names2:
+    - EGYPT
+    r2: EG
+  - names2:
+    - ETHIOPIA
+    r2: ET
+  r1: E
 - names:
   - UNITED KINGDOM
   - UNITED STATES
@@ -858,17 +971,6 @@ snapshots[
     - ROMANIA
     r2: RO
   r1: R
-- names:
-  - EGYPT
-  - ETHIOPIA
-  nested:
-  - names2:
-    - EGYPT
-    r2: EG
-  - names2:
-    - ETHIOPIA
-    r2: ET
-  r1: E
 - names:
   - ALGERIA
   - ARGENTINA
@@ -980,31 +1082,31 @@ snapshots[
 
 snapshots[
     "test_select_backlink_nav_ok 1"
-] = """- (AFRICA)
-- (AMERICA)
-- (AMERICA)
-- (AMERICA)
-- ("MIDDLE EAST")
-- (AFRICA)
-- (EUROPE)
-- (EUROPE)
-- (ASIA)
-- (ASIA)
-- ("MIDDLE EAST")
-- ("MIDDLE EAST")
-- (ASIA)
-- ("MIDDLE EAST")
-- (AFRICA)
-- (AFRICA)
-- (AFRICA)
-- (AMERICA)
-- (ASIA)
-- (EUROPE)
-- ("MIDDLE EAST")
-- (ASIA)
-- (EUROPE)
-- (EUROPE)
-- (AMERICA)
+] = """- AFRICA
+- AMERICA
+- AMERICA
+- AMERICA
+- MIDDLE EAST
+- AFRICA
+- EUROPE
+- EUROPE
+- ASIA
+- ASIA
+- MIDDLE EAST
+- MIDDLE EAST
+- ASIA
+- MIDDLE EAST
+- AFRICA
+- AFRICA
+- AFRICA
+- AMERICA
+- ASIA
+- EUROPE
+- MIDDLE EAST
+- ASIA
+- EUROPE
+- EUROPE
+- AMERICA
 """
 
 snapshots[
@@ -1043,31 +1145,31 @@ snapshots[
 
 snapshots[
     "test_select_link_nav_ok 1"
-] = """- (ALGERIA)
-- (ARGENTINA)
-- (BRAZIL)
-- (CANADA)
-- (EGYPT)
-- (ETHIOPIA)
-- (FRANCE)
-- (GERMANY)
-- (INDIA)
-- (INDONESIA)
-- (IRAN)
-- (IRAQ)
-- (JAPAN)
-- (JORDAN)
-- (KENYA)
-- (MOROCCO)
-- (MOZAMBIQUE)
-- (PERU)
-- (CHINA)
-- (ROMANIA)
-- ("SAUDI ARABIA")
-- (VIETNAM)
-- (RUSSIA)
-- ("UNITED KINGDOM")
-- ("UNITED STATES")
+] = """- ALGERIA
+- ARGENTINA
+- BRAZIL
+- CANADA
+- EGYPT
+- ETHIOPIA
+- FRANCE
+- GERMANY
+- INDIA
+- INDONESIA
+- IRAN
+- IRAQ
+- JAPAN
+- JORDAN
+- KENYA
+- MOROCCO
+- MOZAMBIQUE
+- PERU
+- CHINA
+- ROMANIA
+- SAUDI ARABIA
+- VIETNAM
+- RUSSIA
+- UNITED KINGDOM
+- UNITED STATES
 """
 
 snapshots[
@@ -1564,11 +1666,11 @@ snapshots[
 snapshots[
     "test_select_tables_ok 1"
 ] = """region:
-- (AFRICA)
-- (AMERICA)
-- (ASIA)
-- (EUROPE)
-- ("MIDDLE EAST")
+- AFRICA
+- AMERICA
+- ASIA
+- EUROPE
+- MIDDLE EAST
 """
 
 snapshots[
@@ -1585,11 +1687,65 @@ snapshots[
   num_customers: 253
 """
 
+snapshots[
+    "test_sort_by_table_ok 1"
+] = """- n: EGYPT
+  r: MIDDLE EAST
+- n: IRAN
+  r: MIDDLE EAST
+- n: IRAQ
+  r: MIDDLE EAST
+- n: JORDAN
+  r: MIDDLE EAST
+- n: SAUDI ARABIA
+  r: MIDDLE EAST
+- n: FRANCE
+  r: EUROPE
+- n: GERMANY
+  r: EUROPE
+- n: ROMANIA
+  r: EUROPE
+- n: RUSSIA
+  r: EUROPE
+- n: UNITED KINGDOM
+  r: EUROPE
+- n: CHINA
+  r: ASIA
+- n: INDIA
+  r: ASIA
+- n: INDONESIA
+  r: ASIA
+- n: JAPAN
+  r: ASIA
+- n: VIETNAM
+  r: ASIA
+- n: ARGENTINA
+  r: AMERICA
+- n: BRAZIL
+  r: AMERICA
+- n: CANADA
+  r: AMERICA
+- n: PERU
+  r: AMERICA
+- n: UNITED STATES
+  r: AMERICA
+- n: ALGERIA
+  r: AFRICA
+- n: ETHIOPIA
+  r: AFRICA
+- n: KENYA
+  r: AFRICA
+- n: MOROCCO
+  r: AFRICA
+- n: MOZAMBIQUE
+  r: AFRICA
+"""
+
 snapshots[
     "test_sort_filter_ok 1"
-] = """- (ASIA)
-- (AMERICA)
-- (AFRICA)
+] = """- ASIA
+- AMERICA
+- AFRICA
 """
 
 snapshots[
@@ -1603,9 +1759,9 @@ snapshots[
 
 snapshots[
     "test_sort_take_ok 1"
-] = """- ("MIDDLE EAST")
-- (EUROPE)
-- (ASIA)
+] = """- MIDDLE EAST
+- EUROPE
+- ASIA
 """
 
 snapshots[
@@ -1694,19 +1850,19 @@ snapshots[
 
 snapshots[
     "test_take_filter_ok 1"
-] = """- (AFRICA)
+] = """- AFRICA
 """
 
 snapshots[
     "test_take_region_nation_ok 1"
-] = """- (ALGERIA)
-- (ARGENTINA)
+] = """- ALGERIA
+- ARGENTINA
 """
 
 snapshots[
     "test_take_region_ok 1"
-] = """- (AFRICA)
-- (AMERICA)
+] = """- AFRICA
+- AMERICA
 """
 
 snapshots[
@@ -1730,28 +1886,28 @@ snapshots[
 
 snapshots[
     "test_take_region_x_nation_ok 1"
-] = """- (ALGERIA)
-- (ARGENTINA)
-- (BRAZIL)
-- (CANADA)
-- (ETHIOPIA)
-- (KENYA)
-- (MOROCCO)
-- (MOZAMBIQUE)
-- (PERU)
-- ("UNITED STATES")
+] = """- ALGERIA
+- ARGENTINA
+- BRAZIL
+- CANADA
+- ETHIOPIA
+- KENYA
+- MOROCCO
+- MOZAMBIQUE
+- PERU
+- UNITED STATES
 """
 
 snapshots[
     "test_take_sort_ok 1"
-] = """- (ASIA)
-- (AMERICA)
-- (AFRICA)
+] = """- ASIA
+- AMERICA
+- AFRICA
 """
 
 snapshots[
     "test_take_take_ok 1"
-] = """- (AFRICA)
+] = """- AFRICA
 """
 
 snapshots[